@@ -41,6 +41,105 @@ SESSION_KEY = getattr(settings, 'OAUTH_SESSION_KEY', 'oauth')
 
 SINGLE_ACCESS_TOKEN = getattr(settings, 'OAUTH_SINGLE_ACCESS_TOKEN', False)
 
+# Look tokens and authorization codes up by their binary digest instead of
+# their string value. Run the `oauth2_backfill_digests` command first.
+TOKEN_DIGESTS = getattr(settings, 'OAUTH_TOKEN_DIGESTS', False)
+
+# Store tokens and authorization codes in plaintext next to their digests.
+# Turned off, together with TOKEN_DIGESTS, before running the
+# `oauth2_clear_plaintext` command.
+TOKEN_PLAINTEXT = getattr(settings, 'OAUTH_TOKEN_PLAINTEXT', True)
+
+# Issue self-contained signed access tokens that are verified without a
+# database lookup instead of opaque ones.
+SIGNED_TOKENS = getattr(settings, 'OAUTH_SIGNED_TOKENS', False)
+
+# Functions extracting the access token from a request, tried in order.
+TOKEN_EXTRACTORS = getattr(settings, 'OAUTH_TOKEN_EXTRACTORS', (
+    'provider.oauth2.extractors.header',
+    'provider.oauth2.extractors.query',
+    'provider.oauth2.extractors.cookie',
+    'provider.oauth2.extractors.body',
+))
+
+# Largest form encoded request body, in bytes, parsed to look for an access
+# token.
+BODY_TOKEN_MAX_SIZE = getattr(settings, 'OAUTH_BODY_TOKEN_MAX_SIZE', 64 * 1024)
+
+# Number of resolved access tokens each process keeps in memory. 0 disables
+# the cache.
+TOKEN_CACHE_SIZE = getattr(settings, 'OAUTH_TOKEN_CACHE_SIZE', 0)
+
+# Upper bound in seconds for how long a resolved access token is cached.
+TOKEN_CACHE_TTL = getattr(settings, 'OAUTH_TOKEN_CACHE_TTL', 60)
+
+# Alias of the entry in CACHES that all nodes share resolved access tokens
+# through. None disables the shared cache.
+TOKEN_CACHE_BACKEND = getattr(settings, 'OAUTH_TOKEN_CACHE_BACKEND', None)
+
+# Number of clients each process keeps in memory for client authentication.
+# 0 disables the cache.
+CLIENT_CACHE_SIZE = getattr(settings, 'OAUTH_CLIENT_CACHE_SIZE', 0)
+
+# Seconds a client is cached, and thus how long changes to a client can take
+# to reach the other nodes.
+CLIENT_CACHE_TTL = getattr(settings, 'OAUTH_CLIENT_CACHE_TTL', 60)
+
+# Alias of the entry in CACHES that all nodes share clients through. None
+# disables the shared cache.
+CLIENT_CACHE_BACKEND = getattr(settings, 'OAUTH_CLIENT_CACHE_BACKEND', None)
+
+# Number of rejected access and refresh tokens each process remembers so
+# repeated attempts don't hit the database. 0 disables the cache.
+NEGATIVE_CACHE_SIZE = getattr(settings, 'OAUTH_NEGATIVE_CACHE_SIZE', 0)
+
+NEGATIVE_CACHE_TTL = getattr(settings, 'OAUTH_NEGATIVE_CACHE_TTL', 5 * 60)
+
+# Expected number of live access tokens for the bloom filter rejecting
+# unknown tokens. 0 disables the filter.
+TOKEN_FILTER_CAPACITY = getattr(settings, 'OAUTH_TOKEN_FILTER_CAPACITY', 0)
+
+TOKEN_FILTER_ERROR_RATE = getattr(settings, 'OAUTH_TOKEN_FILTER_ERROR_RATE', 0.01)
+
+# Seconds after which the filter is rebuilt to drop expired tokens.
+TOKEN_FILTER_REBUILD = getattr(settings, 'OAUTH_TOKEN_FILTER_REBUILD', 60 * 60)
+
+# Seconds between syncs of the filter with the tokens issued elsewhere.
+TOKEN_FILTER_SYNC_INTERVAL = getattr(settings,
+    'OAUTH_TOKEN_FILTER_SYNC_INTERVAL', 10)
+
+# Seconds a transaction issuing access tokens may take at most. Each sync of
+# the filter scans the tokens created that long before the previous one
+# again, in case they committed since.
+TOKEN_FILTER_SYNC_WINDOW = getattr(settings, 'OAUTH_TOKEN_FILTER_SYNC_WINDOW',
+    60)
+
+# Dotted paths to the sinks access token resolution is reported to, see
+# provider.oauth2.instrumentation. Empty disables instrumentation.
+INSTRUMENTATION_SINKS = getattr(settings, 'OAUTH_INSTRUMENTATION_SINKS', ())
+
+STATSD_HOST = getattr(settings, 'OAUTH_STATSD_HOST', '127.0.0.1')
+
+STATSD_PORT = getattr(settings, 'OAUTH_STATSD_PORT', 8125)
+
+STATSD_PREFIX = getattr(settings, 'OAUTH_STATSD_PREFIX', 'oauth2')
+
+# Dotted path to the class authorization codes are stored with, see
+# provider.oauth2.stores.
+GRANT_STORE = getattr(settings, 'OAUTH_GRANT_STORE',
+    'provider.oauth2.stores.DatabaseGrantStore')
+
+# Alias of the entry in CACHES that CacheGrantStore keeps codes in.
+GRANT_CACHE_BACKEND = getattr(settings, 'OAUTH_GRANT_CACHE_BACKEND', 'default')
+
+# Seconds during which exchanging a refresh token again returns the pair it
+# was just exchanged for. 0 disables the grace period.
+REFRESH_GRACE_PERIOD = getattr(settings, 'OAUTH_REFRESH_GRACE_PERIOD', 0)
+
+# Alias of the entry in CACHES the pairs are kept in for the grace period.
+REFRESH_GRACE_CACHE_BACKEND = getattr(settings,
+    'OAUTH_REFRESH_GRACE_CACHE_BACKEND', 'default')
+
 LOGO_FOLDER = getattr(settings, 'OAUTH2_LOGO_FOLDER', 'logos')
 
 IMAGE_STORAGE = getattr(settings, 'OAUTH2_IMAGE_STORAGE', None)
\ No newline at end of file
@@ -0,0 +1 @@
+default_app_config = 'provider.oauth2.apps.OAuth2Config'
@@ -2,6 +2,7 @@ import operator
 from django.contrib import admin
 from django import forms
 from .models import AccessToken, Grant, Client, RefreshToken
+from .models import ArchivedAccessToken, ArchivedGrant, ArchivedRefreshToken
 from .. import scope
 
 class ScopeMixin(object):
@@ -25,14 +26,58 @@ class ScopeMixin(object):
 class ModelAdminForm(ScopeMixin, forms.ModelForm):
     pass
 
+class ScopeListFilter(admin.SimpleListFilter):
+    """
+    Filter tokens and grants by the scopes they include, in the database.
+    """
+    title = 'scope'
+    parameter_name = 'scope'
+
+    def lookups(self, request, model_admin):
+        return [(str(value), name) for value, name in scope.SCOPE_CHOICES]
+
+    def queryset(self, request, queryset):
+        # Only the values offered by lookups, anything else isn't filtered on
+        values = dict((str(value), value) for value, name in
+            scope.SCOPE_CHOICES)
+        value = values.get(self.value())
+        if value is not None:
+            return queryset.filter(scope__has_all=value)
+        return queryset
+
+def revoke_tokens(modeladmin, request, queryset):
+    count = queryset.revoke()
+    modeladmin.message_user(request, "%d access tokens revoked." % count)
+revoke_tokens.short_description = "Revoke selected access tokens"
+
+
+def revoke_client_tokens(modeladmin, request, queryset):
+    count = sum(AccessToken.objects.revoke_for(client=client)
+        for client in queryset)
+    modeladmin.message_user(request, "%d access tokens revoked." % count)
+revoke_client_tokens.short_description = \
+    "Revoke all tokens of selected clients"
+
+
 class AccessTokenAdmin(admin.ModelAdmin):
-    list_display = ('user', 'client', 'token', 'expires',)
+    list_display = ('user', 'client', 'token', 'expires', 'is_deleted',)
     raw_id_fields = ('user',)
+    list_filter = ('is_deleted', ScopeListFilter,)
     form = ModelAdminForm
+    actions = [revoke_tokens]
+
+    def get_queryset(self, request):
+        # Revoked tokens are left out by AccessToken.objects
+        queryset = AccessToken.all_objects.get_queryset()
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
 
 
 class GrantAdmin(admin.ModelAdmin):
     list_display = ('user', 'client', 'code', 'expires',)
+    list_filter = (ScopeListFilter,)
     raw_id_fields = ('user',)
     form = ModelAdminForm
 
@@ -41,8 +86,27 @@ class ClientAdmin(admin.ModelAdmin):
     list_display = ('url', 'user', 'redirect_uri', 'client_id', 'client_type')
     raw_id_fields = ('user',)
     form = ModelAdminForm
+    actions = [revoke_client_tokens]
+
+
+class ArchivedAccessTokenAdmin(admin.ModelAdmin):
+    list_display = ('user', 'client', 'token', 'expires', 'archived_at')
+    raw_id_fields = ('user', 'client')
+
+
+class ArchivedGrantAdmin(admin.ModelAdmin):
+    list_display = ('user', 'client', 'code', 'expires', 'archived_at')
+    raw_id_fields = ('user', 'client')
+
+
+class ArchivedRefreshTokenAdmin(admin.ModelAdmin):
+    list_display = ('user', 'client', 'token', 'archived_at')
+    raw_id_fields = ('user', 'client', 'access_token')
 
 admin.site.register(AccessToken, AccessTokenAdmin)
 admin.site.register(Grant, GrantAdmin)
 admin.site.register(Client, ClientAdmin)
 admin.site.register(RefreshToken)
+admin.site.register(ArchivedAccessToken, ArchivedAccessTokenAdmin)
+admin.site.register(ArchivedGrant, ArchivedGrantAdmin)
+admin.site.register(ArchivedRefreshToken, ArchivedRefreshTokenAdmin)
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+
+class OAuth2Config(AppConfig):
+    name = 'provider.oauth2'
+    label = 'oauth2'
+    verbose_name = 'OAuth2'
+
+    def ready(self):
+        from . import receivers
+        from .cache import check_revocations, check_rotations
+        from .managers import check_plaintext
+        check_revocations()
+        check_rotations()
+        check_plaintext()
@@ -1,6 +1,8 @@
-from ..utils import now
+import binascii
+from django.utils.crypto import constant_time_compare
+from .. import constants
 from .forms import (ClientAuthForm, PublicClientAuthForm)
-from .models import AccessToken
+from .models import AccessToken, Client
 
 
 class BaseBackend(object):
@@ -82,6 +84,82 @@ class PublicClientBackend(object):
         return None
 
 
+class ClientBackend(object):
+    """
+    Backend that authenticates a client in a single pass. It looks at the
+    request once to tell which of the ways above the client uses and looks
+    the client up once, instead of trying :class:`BasicClientBackend`,
+    :class:`RequestParamsClientBackend` and :class:`PublicClientBackend` in
+    turn:
+
+     - an HTTP basic authorization header carries the client ID and secret
+     - ``client_id`` and ``client_secret`` parameters authenticate a
+       confidential client
+     - a ``client_id`` parameter alone authenticates a public client for
+       the grant types :class:`PublicClientBackend` allows
+
+    Unlike with the backends tried in turn, credentials that are sent must
+    be right: a public client sending a wrong secret or a malformed
+    authorization header is refused rather than authenticated by its
+    ``client_id`` alone.
+    """
+    public_grant_types = ('password', 'refresh_token', 'authorization_code')
+
+    def authenticate(self, request=None):
+        if request is None:
+            return None
+
+        credentials = self.get_credentials(request)
+        if credentials is None:
+            return None
+        client_id, client_secret = credentials
+
+        try:
+            client = Client.objects.get_client(client_id)
+        except Client.DoesNotExist:
+            return None
+
+        if client_secret is None:
+            if client.client_type != constants.PUBLIC or _param(request,
+                    'grant_type') not in self.public_grant_types:
+                return None
+            return client
+
+        if constant_time_compare(client.client_secret, client_secret):
+            return client
+        return None
+
+    def get_credentials(self, request):
+        """
+        Return the ``(client_id, client_secret)`` pair the request carries,
+        with a ``client_secret`` of ``None`` for public clients, or ``None``
+        if it carries no client ID.
+        """
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+
+        if auth.lower().startswith('basic '):
+            try:
+                client_id, client_secret = auth.split(' ', 1)[1].decode(
+                    'base64').split(':')
+            except (ValueError, binascii.Error):
+                # Auth header was malformed, unpacking went wrong
+                return None
+            return client_id, client_secret
+
+        client_id = _param(request, 'client_id')
+        if not client_id:
+            return None
+        return client_id, _param(request, 'client_secret') or None
+
+
+def _param(request, name):
+    # Body parameters take precedence, like they did in request.REQUEST
+    value = request.POST.get(name)
+    if value is None:
+        value = request.GET.get(name)
+    return value
+
+
 class AccessTokenBackend(object):
     """
     Authenticate a user via access token and client object.
@@ -89,7 +167,6 @@ class AccessTokenBackend(object):
 
     def authenticate(self, access_token=None, client=None):
         try:
-            return AccessToken.objects.get(token=access_token,
-                expires__gt=now(), client=client)
+            return AccessToken.objects.resolve(access_token, client=client)
         except AccessToken.DoesNotExist:
             return None
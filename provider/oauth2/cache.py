@@ -0,0 +1,767 @@
+"""
+In-process caches keeping token resolution off the database on the request
+hot path. Every cache is disabled unless it is sized through the settings
+documented in :attr:`provider.constants`.
+"""
+
+import binascii
+import copy
+import hashlib
+import math
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Max
+from django.utils.encoding import force_bytes
+from .. import constants
+from ..utils import now, read_signed_token, token_digest
+
+
+def _key(prefix, token):
+    # Hash the token, it comes straight from the request and may contain
+    # anything
+    return 'oauth2:%s:%s' % (prefix, hashlib.sha1(force_bytes(token)).hexdigest())
+
+
+def stored_digest(instance, field='token'):
+    """
+    Return the :func:`provider.utils.token_digest` of the token or code
+    ``field`` of ``instance``. Rows saved without their plaintext only have
+    the digest column.
+    """
+    value = getattr(instance, field)
+    if value:
+        return token_digest(value)
+    return getattr(instance, '%s_digest' % field)
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping bounded to :attr:`maxsize` entries. Each entry lives
+    for at most :attr:`ttl` seconds; once full, the least recently used entry
+    is evicted.
+
+    A cache with a ``maxsize`` of ``0`` never stores anything.
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if not self._data:
+            return default
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires <= self.timer():
+                return default
+            # Re-insert to mark the entry as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store ``value`` under ``key``. ``ttl`` can only shorten the default
+        time to live of the cache, never extend it.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.timer() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TokenCache(object):
+    """
+    Cache of resolved :class:`provider.oauth2.models.AccessToken` objects
+    keyed by the digest of their token, so that rows read back without their
+    plaintext can be evicted. Cached tokens carry their user and client so a
+    hit resolves a request without touching the database.
+
+    Tokens are kept in an in-process :class:`LRUCache` or, if ``backend``
+    names one of the ``CACHES``, in a cache shared by all nodes instead. An
+    in-process copy can't be told about an invalidation on another node, so
+    there is no in-process tier in front of the shared cache.
+
+    Entries never outlive the token they hold: the time to live is capped by
+    :meth:`provider.oauth2.models.AccessToken.get_expire_delta`.
+    """
+
+    def __init__(self, maxsize=None, ttl=None, backend=None):
+        if maxsize is None:
+            maxsize = constants.TOKEN_CACHE_SIZE
+        if ttl is None:
+            ttl = constants.TOKEN_CACHE_TTL
+        if backend is None:
+            backend = constants.TOKEN_CACHE_BACKEND
+        self.ttl = ttl
+        self.backend = backend
+        self.local = LRUCache(0 if backend is not None else maxsize, ttl)
+
+    @property
+    def shared(self):
+        if self.backend is None:
+            return None
+        return caches[self.backend]
+
+    def key(self, digest):
+        return 'oauth2:token:%s' % binascii.hexlify(digest)
+
+    def get(self, token):
+        """
+        Return a copy of the cached access token for ``token`` or ``None``.
+        Copies are handed out so that requests can't leak changes to their
+        user into each other.
+        """
+        digest = token_digest(token)
+        if self.backend is not None:
+            access_token = self.shared.get(self.key(digest))
+        else:
+            access_token = self.local.get(digest)
+        if access_token is None:
+            return None
+
+        access_token = copy.copy(access_token)
+        if access_token.user_id is not None:
+            access_token.user = copy.copy(access_token.user)
+        return access_token
+
+    def set(self, access_token):
+        ttl = min(access_token.get_expire_delta(), self.ttl)
+        if ttl <= 0:
+            return
+        digest = stored_digest(access_token)
+        if self.backend is not None:
+            self.shared.set(self.key(digest), access_token, ttl)
+        else:
+            self.local.set(digest, access_token, ttl=ttl)
+
+    def delete(self, token):
+        self._delete(token_digest(token))
+
+    def discard(self, access_token):
+        """
+        Drop ``access_token``, which may have been read back without its
+        plaintext.
+        """
+        self._delete(stored_digest(access_token))
+
+    def _delete(self, digest):
+        self.local.delete(digest)
+        if self.backend is not None:
+            self.shared.delete(self.key(digest))
+
+    def clear(self):
+        """
+        Clear the in-process tier. Shared entries expire on their own.
+        """
+        self.local.clear()
+
+
+class ClientCache(object):
+    """
+    Cache of :class:`provider.oauth2.models.Client` objects keyed by their
+    ``client_id``, sparing client authentication and the authorization views
+    a query per request.
+
+    Clients are kept in an in-process :class:`LRUCache` and, if ``backend``
+    names one of the ``CACHES``, in a cache shared by all nodes. The shared
+    cache also holds a version counter per client, bumped by the signal
+    receivers whenever the client is saved or deleted. Entries of both tiers
+    are stored with the version they were read at and only returned while it
+    is current, so changes reach every node right away, at the cost of one
+    round trip to the shared cache per lookup. Without a shared cache they
+    reach the other processes once their entries expire, after at most
+    ``ttl`` seconds.
+
+    Shared keys are also versioned by the fields of the model, so nodes
+    running code with a different ``Client`` don't read each other's
+    entries.
+    """
+
+    def __init__(self, maxsize=None, ttl=None, backend=None):
+        if maxsize is None:
+            maxsize = constants.CLIENT_CACHE_SIZE
+        if ttl is None:
+            ttl = constants.CLIENT_CACHE_TTL
+        if backend is None:
+            backend = constants.CLIENT_CACHE_BACKEND
+        self.ttl = ttl
+        self.backend = backend
+        self.local = LRUCache(maxsize, ttl)
+        self._schema = None
+
+    @property
+    def shared(self):
+        if self.backend is None:
+            return None
+        return caches[self.backend]
+
+    @property
+    def schema(self):
+        if self._schema is None:
+            from .models import Client
+            fields = ','.join(field.attname for field
+                in Client._meta.concrete_fields)
+            self._schema = hashlib.sha1(force_bytes(fields)).hexdigest()[:8]
+        return self._schema
+
+    def key(self, client_id):
+        return _key('client', client_id)
+
+    def version_key(self, client_id):
+        return _key('client-version', client_id)
+
+    def version(self, client_id):
+        """
+        Return the current version of the client for ``client_id``, ``None``
+        without a shared cache.
+        """
+        if self.backend is None:
+            return None
+        key = self.version_key(client_id)
+        version = self.shared.get(key, version=self.schema)
+        if version is None:
+            # Start from the clock rather than 0, so that entries read before
+            # the counter was evicted don't become current again
+            self.shared.add(key, int(time.time() * 1000), None,
+                version=self.schema)
+            version = self.shared.get(key, version=self.schema)
+        return version
+
+    def bump(self, client_id):
+        """
+        Make the entries of every node for ``client_id`` stale.
+        """
+        if self.backend is None:
+            return
+        key = self.version_key(client_id)
+        try:
+            self.shared.incr(key, version=self.schema)
+        except ValueError:
+            # Nothing was read at a version that isn't there
+            self.shared.add(key, int(time.time() * 1000), None,
+                version=self.schema)
+
+    def get(self, client_id):
+        """
+        Return a copy of the cached client for ``client_id`` or ``None``.
+        """
+        version = self.version(client_id)
+        entry = self.local.get(client_id)
+
+        if entry is None or entry[0] != version:
+            if self.backend is None:
+                return None
+            entry = self.shared.get(self.key(client_id), version=self.schema)
+            if entry is None or entry[0] != version:
+                return None
+            self.local.set(client_id, entry)
+
+        return copy.copy(entry[1])
+
+    def set(self, client, version=None):
+        """
+        Cache ``client`` as read at ``version``, which should be taken from
+        :meth:`version` before the client was read so that a change in
+        between isn't cached as current. Defaults to the current version.
+        """
+        if version is None:
+            version = self.version(client.client_id)
+        entry = (version, client)
+        self.local.set(client.client_id, entry)
+        if self.backend is not None:
+            self.shared.set(self.key(client.client_id), entry, self.ttl,
+                version=self.schema)
+
+    def delete(self, client_id):
+        self.local.delete(client_id)
+        if self.backend is not None:
+            self.shared.delete(self.key(client_id), version=self.schema)
+
+
+class RevocationList(object):
+    """
+    Signed access tokens (see :func:`provider.utils.signed_token`) that were
+    invalidated before they expired. Signed tokens are verified without a
+    lookup, so this list is all that stands between a revoked token and the
+    resources it grants access to.
+
+    Revocations are kept in process until the token expires and are never
+    evicted before, as that would make the token valid again. If ``backend``
+    names one of the ``CACHES`` they are also published there for the other
+    nodes; that cache must not evict entries early either. With
+    :attr:`provider.constants.SIGNED_TOKENS` set, :func:`check_revocations`
+    makes sure there is such a cache.
+    """
+
+    def __init__(self, backend=None, timer=time.time):
+        if backend is None:
+            backend = constants.TOKEN_CACHE_BACKEND
+        self.backend = backend
+        self.timer = timer
+        self._revoked = {}
+        self._pruned_size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        if self.backend is None:
+            return None
+        return caches[self.backend]
+
+    def key(self, token):
+        return _key('revoked', token)
+
+    def revoke(self, token, expires_in):
+        """
+        Revoke ``token`` for the ``expires_in`` seconds it would otherwise
+        still be valid.
+        """
+        if expires_in <= 0:
+            return
+        with self._lock:
+            current = self.timer()
+            self._revoked[token] = current + expires_in
+            # Drop expired revocations whenever the list doubled in size
+            if len(self._revoked) > 2 * self._pruned_size:
+                self._revoked = dict((key, expires) for key, expires
+                    in self._revoked.items() if expires > current)
+                self._pruned_size = len(self._revoked)
+        if self.backend is not None:
+            self.shared.set(self.key(token), True, expires_in)
+
+    def is_revoked(self, token):
+        expires = self._revoked.get(token)
+        if expires is not None and expires > self.timer():
+            return True
+        if self.backend is not None:
+            return bool(self.shared.get(self.key(token)))
+        return False
+
+
+# Cache backends whose entries don't reach other processes or outlive a
+# restart
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def check_revocations():
+    """
+    Raise :class:`django.core.exceptions.ImproperlyConfigured` if signed
+    access tokens are issued but :attr:`revoked` can't share revocations
+    between processes: a token revoked in one process would stay valid in
+    all others and in every process started later.
+    """
+    if not constants.SIGNED_TOKENS:
+        return
+    backend = constants.TOKEN_CACHE_BACKEND
+    if backend is None:
+        raise ImproperlyConfigured("OAUTH_SIGNED_TOKENS requires "
+            "OAUTH_TOKEN_CACHE_BACKEND to share revocations between "
+            "processes.")
+    if settings.CACHES.get(backend, {}).get('BACKEND') in \
+            LOCAL_CACHE_BACKENDS:
+        raise ImproperlyConfigured("OAUTH_TOKEN_CACHE_BACKEND must name a "
+            "cache shared by all processes when OAUTH_SIGNED_TOKENS is set, "
+            "%r is local to each process." % backend)
+
+
+def check_rotations():
+    """
+    Raise :class:`django.core.exceptions.ImproperlyConfigured` if refresh
+    tokens have a grace period but :attr:`rotated` can't share the pairs
+    they were exchanged for between processes: a repeated exchange handled
+    by another process would be refused.
+    """
+    if constants.REFRESH_GRACE_PERIOD <= 0:
+        return
+    backend = constants.REFRESH_GRACE_CACHE_BACKEND
+    if settings.CACHES.get(backend, {}).get('BACKEND') in \
+            LOCAL_CACHE_BACKENDS:
+        raise ImproperlyConfigured("OAUTH_REFRESH_GRACE_CACHE_BACKEND must "
+            "name a cache shared by all processes when "
+            "OAUTH_REFRESH_GRACE_PERIOD is set, %r is local to each process."
+            % backend)
+
+
+class BloomFilter(object):
+    """
+    Compact set membership test. :meth:`might_contain` never returns
+    ``False`` for an item that was added and returns ``True`` for an item that
+    wasn't with a probability of about ``error_rate`` as long as no more than
+    ``capacity`` items are added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(int(math.ceil(bits)), 8)
+        self.hashes = max(int(round(self.size / float(capacity) * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: derive all positions from two 64 bit halves
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(force_bytes(item)).digest())
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, item):
+        for position in self._positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class LiveTokenFilter(object):
+    """
+    :class:`BloomFilter` of the digests of the unexpired access tokens, used
+    to reject unknown tokens without an indexed lookup.
+
+    A token that isn't in the filter may still have been issued by another
+    process since the filter was last synced with the database. A miss is
+    only reported if a sync that started after the token was received has
+    completed; otherwise the token goes on to the regular lookup and a sync
+    is handed to ``spawn``, at most one every ``sync_interval`` seconds. A
+    sync adds the tokens created since the previous one -- a primary key
+    range scan that only returns the newest rows.
+
+    Rows don't become visible in primary key order: a transaction issuing
+    tokens may commit after one that inserted higher keys. Each sync thus
+    scans again the keys that were handed out up to ``sync_window`` seconds
+    before the previous sync started. As long as no transaction issuing
+    tokens takes longer than that, a token a client could hold is never
+    rejected by mistake.
+
+    Expired and invalidated tokens stay in the filter until the next full
+    rebuild, every ``rebuild_interval`` seconds, and only cost a regular
+    lookup until then. Rebuilds are handed to ``spawn``, by default a
+    background thread; the filter keeps answering from the previous build,
+    or lets every token through before the first, in the meantime.
+    """
+
+    def __init__(self, capacity=None, error_rate=None, rebuild_interval=None,
+            sync_interval=None, sync_window=None, timer=time.time, spawn=None):
+        self.capacity = constants.TOKEN_FILTER_CAPACITY if capacity is None \
+            else capacity
+        self.error_rate = constants.TOKEN_FILTER_ERROR_RATE if \
+            error_rate is None else error_rate
+        self.rebuild_interval = constants.TOKEN_FILTER_REBUILD if \
+            rebuild_interval is None else rebuild_interval
+        self.sync_interval = constants.TOKEN_FILTER_SYNC_INTERVAL if \
+            sync_interval is None else sync_interval
+        self.sync_window = constants.TOKEN_FILTER_SYNC_WINDOW if \
+            sync_window is None else sync_window
+        self.timer = timer
+        self.spawn = _spawn_thread if spawn is None else spawn
+        self.filter = None
+        # (started, watermark) of the last build and syncs: the highest key
+        # visible to the scan that started then
+        self.watermarks = []
+        self.built_at = None
+        self.synced_at = None
+        # When the last sync was handed to `spawn`
+        self.sync_scheduled_at = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._syncing = False
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    @property
+    def watermark(self):
+        return self.watermarks[-1][1] if self.watermarks else 0
+
+    def might_contain(self, token):
+        """
+        Return ``False`` if ``token`` is definitely not a live access token.
+        Always ``True`` while the filter is disabled or not built yet.
+        """
+        if not self.enabled:
+            return True
+
+        received = self.timer()
+
+        if self.filter is None or \
+                received - self.built_at > self.rebuild_interval:
+            self.schedule_rebuild()
+            if self.filter is None:
+                return True
+
+        if self.filter.might_contain(token_digest(token)):
+            return True
+        if self.synced_at >= received:
+            return False
+        # Possibly issued elsewhere since the last sync
+        self.schedule_sync()
+        return True
+
+    def add(self, token):
+        """
+        Add a freshly issued token without waiting for the next sync.
+        """
+        if self.filter is not None:
+            self.filter.add(token_digest(token))
+
+    def schedule_rebuild(self):
+        """
+        Have ``spawn`` rebuild the filter, unless a rebuild is under way.
+        """
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        try:
+            self.spawn(self._rebuild)
+        except Exception:
+            self._rebuilding = False
+            raise
+
+    def schedule_sync(self):
+        """
+        Have ``spawn`` sync the filter, unless a sync is under way or was
+        scheduled less than ``sync_interval`` seconds ago.
+        """
+        with self._lock:
+            scheduled = self.timer()
+            if self._syncing or (self.sync_scheduled_at is not None and
+                    scheduled - self.sync_scheduled_at < self.sync_interval):
+                return
+            self._syncing = True
+            self.sync_scheduled_at = scheduled
+        try:
+            self.spawn(self._sync)
+        except Exception:
+            self._syncing = False
+            raise
+
+    def _sync(self):
+        try:
+            self.sync()
+        finally:
+            self._syncing = False
+
+    def _rebuild(self):
+        try:
+            self.rebuild()
+        finally:
+            self._rebuilding = False
+
+    def rebuild(self):
+        """
+        Rebuild the filter from the live tokens in the database. Runs on the
+        calling thread; syncs meanwhile go to the previous filter.
+        """
+        from .models import AccessToken
+
+        started = self.timer()
+        cutoff = now() - timedelta(seconds=self.sync_window)
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        # Anything created after this point is picked up by `sync`
+        watermark = AccessToken.objects.aggregate(
+            watermark=Max('pk'))['watermark'] or 0
+        # Keys up to settled were handed out a sync window before the scan,
+        # their rows are visible to it
+        settled = 0
+        live = AccessToken.objects.filter(pk__lte=watermark,
+            expires__gt=now()).values_list('pk', 'token', 'token_digest',
+            'created_at')
+        for pk, token, digest, created_at in live.iterator():
+            bloom.add(digest if digest is not None else token_digest(token))
+            if created_at < cutoff:
+                settled = max(settled, pk)
+
+        with self._lock:
+            self.filter = bloom
+            self.watermarks = [(started - self.sync_window, settled),
+                (started, watermark)]
+            self.built_at = self.synced_at = started
+
+    def sync(self):
+        """
+        Add the tokens created since the last sync and those that may have
+        committed since. Runs on the calling thread without blocking
+        :meth:`might_contain`.
+        """
+        from .models import AccessToken
+
+        with self._lock:
+            bloom = self.filter
+            if bloom is None:
+                return
+            started = self.timer()
+
+            # Keys handed out a sync window before the last sync started
+            # were visible to it
+            settled = self.synced_at - self.sync_window
+            while len(self.watermarks) > 1 and \
+                    self.watermarks[1][0] <= settled:
+                self.watermarks.pop(0)
+            if self.watermarks[0][0] > settled:
+                # Nothing is known to be visible that long ago
+                low = 0
+            else:
+                low = self.watermarks[0][1]
+            watermark = self.watermark
+
+        created = AccessToken.objects.filter(pk__gt=low,
+            expires__gt=now()).values_list('pk', 'token', 'token_digest')
+        for pk, token, digest in created.iterator():
+            bloom.add(digest if digest is not None else token_digest(token))
+            watermark = max(watermark, pk)
+
+        with self._lock:
+            # A rebuild swapped the filter meanwhile and set its own
+            # watermarks, the next sync starts from those
+            if self.filter is bloom:
+                self.watermarks.append((started, watermark))
+                self.synced_at = started
+
+
+def _spawn_thread(target):
+    def run():
+        try:
+            target()
+        finally:
+            # The thread opened its own connection
+            connection.close()
+    thread = threading.Thread(target=run, name='oauth2-live-token-filter')
+    thread.daemon = True
+    thread.start()
+
+
+class RotatedTokens(object):
+    """
+    Access tokens issued by exchanging a refresh token, kept for ``ttl``
+    seconds after the exchange in the ``backend`` cache so that concurrent
+    exchanges of the same refresh token can be answered with the same
+    tokens. Entries are keyed by the client and the refresh token, which
+    only the client holds.
+
+    Pairs are published once the exchange commits. :meth:`wait` polls for a
+    pair up to ``retries`` times, ``retry_delay`` seconds apart, for requests
+    that find the refresh token exchanged before that.
+    """
+
+    def __init__(self, ttl=None, backend=None, retries=5, retry_delay=0.05,
+            sleep=time.sleep):
+        self.ttl = constants.REFRESH_GRACE_PERIOD if ttl is None else ttl
+        self.backend = constants.REFRESH_GRACE_CACHE_BACKEND if \
+            backend is None else backend
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.sleep = sleep
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @property
+    def shared(self):
+        return caches[self.backend]
+
+    def key(self, client_id, token):
+        return _key('rotated', '%s:%s' % (client_id, token))
+
+    def get(self, client_id, token):
+        if not self.enabled:
+            return None
+        return self.shared.get(self.key(client_id, token))
+
+    def wait(self, client_id, token):
+        """
+        Like :meth:`get`, but give an exchange that committed without
+        publishing its pair yet a moment to do so.
+        """
+        access_token = self.get(client_id, token)
+        if not self.enabled:
+            return access_token
+        for attempt in range(self.retries):
+            if access_token is not None:
+                break
+            self.sleep(self.retry_delay)
+            access_token = self.get(client_id, token)
+        return access_token
+
+    def set(self, client_id, token, access_token):
+        if self.enabled:
+            self.shared.set(self.key(client_id, token), access_token,
+                self.ttl)
+
+
+tokens = TokenCache()
+"""
+The token cache shared by the middleware and views of this process.
+"""
+
+rejected = LRUCache(constants.NEGATIVE_CACHE_SIZE,
+    constants.NEGATIVE_CACHE_TTL)
+"""
+Recently rejected access and refresh tokens. Keys are ``('access', token)``
+and ``('refresh', client_id, token)`` tuples.
+"""
+
+live_tokens = LiveTokenFilter()
+"""
+The live access token filter of this process.
+"""
+
+clients = ClientCache()
+"""
+The client cache shared by the client authentication backends and the views
+of this process.
+"""
+
+revoked = RevocationList()
+"""
+The signed access tokens revoked before their expiry.
+"""
+
+rotated = RotatedTokens()
+"""
+The access tokens recently issued for refresh tokens.
+"""
+
+
+def evict(access_token):
+    """
+    Drop ``access_token`` from :attr:`tokens` and, if it is a signed token,
+    add it to :attr:`revoked`. Invalidations that don't go through the
+    model's signals must call this once they are committed.
+    """
+    tokens.discard(access_token)
+    if read_signed_token(access_token.token) is not None:
+        revoked.revoke(access_token.token, access_token.get_expire_delta())
@@ -0,0 +1,76 @@
+"""
+View decorators requiring the access token of a request to grant a scope.
+They check the token loaded by
+:class:`provider.oauth2.middleware.AuthenticationMiddleware` and never query
+the database themselves.
+"""
+
+import json
+from functools import wraps
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponseForbidden
+from django.utils.decorators import available_attrs
+from .. import scope
+from .middleware import HttpResponseUnauthorized
+
+
+def required_scope(*names):
+    """
+    Turn scope names into the bitmask an access token must grant. Fails
+    loudly on unknown names, which would otherwise grant access to anyone.
+    """
+    unknown = [name for name in names if name not in scope.SCOPE_NAME_DICT]
+    if unknown:
+        raise ImproperlyConfigured('Unknown scopes: %s' % ', '.join(unknown))
+    return scope.to_int(*names)
+
+
+def scope_denied(request, wants):
+    """
+    Return the error response for a request whose access token doesn't grant
+    the ``wants`` scope bitmask, ``None`` if it does.
+    """
+    token = getattr(request, 'oauth_token', None)
+
+    if not token:
+        response = HttpResponseUnauthorized(
+            json.dumps({'error': 'invalid_token'}),
+            content_type='application/json')
+        response['WWW-Authenticate'] = 'Bearer error="invalid_token"'
+        return response
+
+    if not scope.check(wants, token.scope):
+        response = HttpResponseForbidden(
+            json.dumps({'error': 'insufficient_scope'}),
+            content_type='application/json')
+        response['WWW-Authenticate'] = 'Bearer error="insufficient_scope"'
+        return response
+
+    return None
+
+
+def scope_required(*names):
+    """
+    Decorator for views that require an access token granting all the scopes
+    ``names``, as defined in :attr:`provider.constants.SCOPES`.
+
+    Requests without a valid access token get a ``401``, requests whose token
+    lacks a scope a ``403``.
+
+    ::
+
+        @scope_required('write')
+        def update_profile(request):
+            ...
+    """
+    wants = required_scope(*names)
+
+    def decorator(view_func):
+        @wraps(view_func, assigned=available_attrs(view_func))
+        def _wrapped_view(request, *args, **kwargs):
+            response = scope_denied(request, wants)
+            if response is not None:
+                return response
+            return view_func(request, *args, **kwargs)
+        return _wrapped_view
+    return decorator
@@ -0,0 +1,73 @@
+"""
+Functions extracting the access token from a request for
+:class:`provider.oauth2.middleware.AuthenticationMiddleware`. They are tried
+in the order given by :attr:`provider.constants.TOKEN_EXTRACTORS`.
+
+An extractor takes the request and returns the token, ``None`` if the token
+isn't where it looks, or an empty string to stop looking and treat the
+request as anonymous, e.g. for a malformed header.
+"""
+
+from .. import constants
+
+AUTHORIZATION_SCHEMES = ('token', 'bearer')
+"""
+Schemes of the ``Authorization`` header carrying an access token.
+"""
+
+
+def header(request):
+    """
+    ``Authorization: Bearer <OAUTH-TOKEN>`` or
+    ``Authorization: token <OAUTH-TOKEN>``
+    """
+    auth_header = request.META.get('HTTP_AUTHORIZATION')
+    if not auth_header:
+        return None
+
+    scheme, _, token = auth_header.partition(' ')
+    if scheme.lower() not in AUTHORIZATION_SCHEMES:
+        return None
+
+    return token.strip()
+
+
+def query(request):
+    """
+    ``?access_token=<OAUTH-TOKEN>``
+    """
+    return request.GET.get('access_token')
+
+
+def cookie(request):
+    """
+    Cookie: ``at=<OAUTH-TOKEN>``
+    """
+    return request.COOKIES.get('at')
+
+
+def body(request):
+    """
+    ``access_token=<OAUTH-TOKEN>`` in a form encoded request body. Bodies of
+    any other type or larger than :attr:`provider.constants.BODY_TOKEN_MAX_SIZE`
+    bytes are left alone rather than read and parsed.
+    """
+    # Bodies parsed earlier on are free to look at
+    if hasattr(request, '_post'):
+        return request.POST.get('access_token')
+
+    if request.method != 'POST':
+        return None
+
+    content_type = request.META.get('CONTENT_TYPE', '')
+    if not content_type.startswith('application/x-www-form-urlencoded'):
+        return None
+
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None
+    if length > constants.BODY_TOKEN_MAX_SIZE:
+        return None
+
+    return request.POST.get('access_token')
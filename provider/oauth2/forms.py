@@ -1,13 +1,13 @@
 from django import forms
-from django.contrib.auth import authenticate
+from django.utils.crypto import constant_time_compare
 from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext as _
 from .. import scope
 from ..constants import RESPONSE_TYPE_CHOICES, SCOPES
 from ..forms import OAuthForm, OAuthValidationError
 from ..scope import SCOPE_NAMES
-from ..utils import now
-from .models import Client, Grant, RefreshToken
+from .models import Client, Grant
+from . import validators
 
 class ClientForm(forms.ModelForm):
     """
@@ -34,9 +34,11 @@ class ClientAuthForm(forms.Form):
     def clean(self):
         data = self.cleaned_data
         try:
-            client = Client.objects.get(client_id=data.get('client_id'),
-                client_secret=data.get('client_secret'))
+            client = Client.objects.get_client(data.get('client_id'))
         except Client.DoesNotExist:
+            client = None
+        if client is None or not constant_time_compare(client.client_secret,
+                data.get('client_secret') or ''):
             raise forms.ValidationError(_("Client could not be validated with "
                 "key pair."))
 
@@ -64,7 +66,7 @@ class PublicClientAuthForm(forms.Form):
         data = self.cleaned_data
 
         try:
-            client = Client.objects.get(client_id=data.get('client_id'))
+            client = Client.objects.get_client(data.get('client_id'))
         except Client.DoesNotExist:
             raise forms.ValidationError(_('Client not found'))
 
@@ -248,18 +250,8 @@ class RefreshTokenGrantForm(ScopeMixin, OAuthForm):
     scope = ScopeChoiceField(choices=SCOPE_NAMES, required=False)
 
     def clean_refresh_token(self):
-        token = self.cleaned_data.get('refresh_token')
-
-        if not token:
-            raise OAuthValidationError({'error': 'invalid_request'})
-
-        try:
-            token = RefreshToken.objects.get(token=token,
-                expired=False, client=self.client)
-        except RefreshToken.DoesNotExist:
-            raise OAuthValidationError({'error': 'invalid_grant'})
-
-        return token
+        return validators.clean_refresh_token(
+            self.cleaned_data.get('refresh_token'), self.client)
 
     def clean(self):
         """
@@ -290,16 +282,7 @@ class AuthorizationCodeGrantForm(ScopeMixin, OAuthForm):
 
     def clean_code(self):
         code = self.cleaned_data.get('code')
-
-        if not code:
-            raise OAuthValidationError({'error': 'invalid_request'})
-
-        try:
-            self.cleaned_data['grant'] = Grant.objects.get(
-                code=code, client=self.client, expires__gt=now())
-        except Grant.DoesNotExist:
-            raise OAuthValidationError({'error': 'invalid_grant'})
-
+        self.cleaned_data['grant'] = validators.clean_code(code, self.client)
         return code
 
     def clean(self):
@@ -347,11 +330,6 @@ class PasswordGrantForm(ScopeMixin, OAuthForm):
     def clean(self):
         data = self.cleaned_data
 
-        user = authenticate(username=data.get('username').lower(),
-            password=data.get('password'))
-
-        if user is None:
-            raise OAuthValidationError({'error': 'invalid_credentials'})
-
-        data['user'] = user
+        data['user'] = validators.clean_credentials(data.get('username'),
+            data.get('password'))
         return data
@@ -0,0 +1,95 @@
+"""
+Indexes of the access token, refresh token and authorization code lookups.
+Which of them a database needs depends on the settings, so they are managed
+here instead of through the models' ``index_together``:
+
+* the :attr:`DIGEST` indexes only once
+  :attr:`provider.constants.TOKEN_DIGESTS` is set. The
+  ``oauth2_backfill_digests`` management command creates them.
+* the :attr:`PLAINTEXT` indexes only until the plaintext columns are
+  cleared by the ``oauth2_clear_plaintext`` management command, which drops
+  them.
+
+Access token indexes leave out revoked tokens on the databases supporting
+partial indexes.
+
+Indexes are told apart by their columns, whatever their name, so those
+created by earlier migrations are picked up as well.
+"""
+
+# Literal for false in the WHERE clause of partial indexes, by vendor
+PARTIAL = {
+    'postgresql': 'false',
+    'sqlite': '0',
+}
+
+# (table, name, columns, partial)
+PLAINTEXT = (
+    ('oauth2_accesstoken', 'oauth2_accesstoken_live_token',
+        ('token', 'expires', 'user_id'), True),
+    ('oauth2_refreshtoken', 'oauth2_refreshtoken_token',
+        ('token', 'client_id', 'expired'), False),
+    ('oauth2_grant', 'oauth2_grant_code',
+        ('code', 'client_id', 'expires'), False),
+)
+
+DIGEST = (
+    ('oauth2_accesstoken', 'oauth2_accesstoken_live_digest',
+        ('token_digest', 'expires', 'user_id'), True),
+    ('oauth2_refreshtoken', 'oauth2_refreshtoken_digest',
+        ('token_digest', 'client_id', 'expired'), False),
+    ('oauth2_grant', 'oauth2_grant_code_digest',
+        ('code_digest', 'client_id', 'expires'), False),
+)
+
+
+def index_names(connection, table, columns):
+    """
+    Return the names of the indexes on exactly ``columns`` of ``table``.
+    """
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    return [name for name, constraint in constraints.items()
+        if constraint['index'] and not constraint['unique'] and
+        not constraint['primary_key'] and
+        tuple(constraint['columns']) == tuple(columns)]
+
+
+def create_indexes(schema_editor, indexes):
+    """
+    Create those of ``indexes`` that don't exist yet. Returns their names.
+    """
+    connection = schema_editor.connection
+    quote = schema_editor.quote_name
+    created = []
+    for table, name, columns, partial in indexes:
+        if index_names(connection, table, columns):
+            continue
+        extra = ''
+        if partial and connection.vendor in PARTIAL:
+            extra = ' WHERE %s = %s' % (quote('is_deleted'),
+                PARTIAL[connection.vendor])
+        schema_editor.execute(schema_editor.sql_create_index % {
+            'name': quote(name),
+            'table': quote(table),
+            'columns': ', '.join(quote(column) for column in columns),
+            'extra': extra,
+        })
+        created.append(name)
+    return created
+
+
+def drop_indexes(schema_editor, indexes):
+    """
+    Drop every index on the columns of ``indexes``. Returns their names.
+    """
+    connection = schema_editor.connection
+    dropped = []
+    for table, name, columns, partial in indexes:
+        for existing in index_names(connection, table, columns):
+            schema_editor.execute(schema_editor.sql_delete_index % {
+                'name': schema_editor.quote_name(existing),
+                'table': schema_editor.quote_name(table),
+            })
+            dropped.append(existing)
+    return dropped
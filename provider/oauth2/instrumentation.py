@@ -0,0 +1,125 @@
+"""
+Reports how the authentication middleware resolves access tokens to the sinks
+listed in :attr:`provider.constants.INSTRUMENTATION_SINKS`. With no sinks
+configured nothing is measured.
+
+For every request the middleware authenticates, each sink's ``record`` method
+is called with:
+
+``source``
+    Name of the extractor the token was found by (see
+    :attr:`provider.constants.TOKEN_EXTRACTORS`), ``None`` if there was none.
+``outcome``
+    :attr:`CACHED`, :attr:`LOADED` or :attr:`SIGNED` if the token was valid,
+    one of the :attr:`REJECTIONS` otherwise.
+``duration``
+    Seconds spent extracting and resolving the token.
+"""
+
+import socket
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+from .. import constants
+
+CACHED = 'cached'
+"""
+Resolved from :attr:`provider.oauth2.cache.tokens`, a cache hit.
+"""
+
+LOADED = 'loaded'
+"""
+Loaded from the database, a cache miss.
+"""
+
+SIGNED = 'signed'
+"""
+A signed token, verified without a lookup.
+"""
+
+NO_TOKEN = 'no_token'
+KNOWN_INVALID = 'known_invalid'
+FILTERED = 'filtered'
+NOT_FOUND = 'not_found'
+INACTIVE_USER = 'inactive_user'
+EXPIRED = 'expired'
+REVOKED = 'revoked'
+
+REJECTIONS = (NO_TOKEN, KNOWN_INVALID, FILTERED, NOT_FOUND, INACTIVE_USER,
+    EXPIRED, REVOKED)
+"""
+Reasons for not authenticating a request: it carried no token, the token was
+rejected recently, the live token filter or the database doesn't know it,
+its user is inactive, or it is a signed token that expired or was revoked.
+"""
+
+token_resolved = Signal()
+"""
+Sent by :class:`SignalSink` with the ``source``, ``outcome`` and ``duration``
+of every resolution.
+"""
+
+
+class SignalSink(object):
+    """
+    Sends :attr:`token_resolved`.
+    """
+
+    def record(self, source, outcome, duration):
+        token_resolved.send(sender=self.__class__, source=source,
+            outcome=outcome, duration=duration)
+
+
+class StatsdSink(object):
+    """
+    Sends a statsd packet per resolution to :attr:`provider.constants.STATSD_HOST`
+    and :attr:`provider.constants.STATSD_PORT`, counting the ``source`` and
+    ``outcome`` and timing the resolution::
+
+        oauth2.source.header:1|c
+        oauth2.outcome.cached:1|c
+        oauth2.resolve:0.124|ms
+
+    Packets are sent over UDP and dropped if they can't be, authentication
+    never waits on the metrics.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        host = constants.STATSD_HOST if host is None else host
+        port = constants.STATSD_PORT if port is None else port
+        self.prefix = constants.STATSD_PREFIX if prefix is None else prefix
+        # Resolve the address once rather than on every packet
+        family, _, _, _, self.address = socket.getaddrinfo(host, port, 0,
+            socket.SOCK_DGRAM)[0]
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def record(self, source, outcome, duration):
+        packet = '%s.source.%s:1|c\n%s.outcome.%s:1|c\n%s.resolve:%.3f|ms' % (
+            self.prefix, source or 'none', self.prefix, outcome, self.prefix,
+            duration * 1000)
+        try:
+            self.socket.sendto(packet.encode('ascii'), self.address)
+        except socket.error:
+            pass
+
+
+_sinks = {}
+
+
+def get_sinks():
+    """
+    Return instances of the sinks configured in
+    :attr:`provider.constants.INSTRUMENTATION_SINKS`, an empty list if there
+    are none.
+    """
+    paths = tuple(constants.INSTRUMENTATION_SINKS)
+    try:
+        return _sinks[paths]
+    except KeyError:
+        _sinks[paths] = [import_string(path)() for path in paths]
+        return _sinks[paths]
+
+
+def record(sinks, source, outcome, duration):
+    for sink in sinks:
+        sink.record(source, outcome, duration)
@@ -0,0 +1,133 @@
+"""
+Removal of the grants and tokens that can no longer be used. Unless
+:attr:`provider.constants.DELETE_EXPIRED` is set, invalidated grants and
+tokens stay in their tables; see the ``oauth2_purge_expired`` management
+command. Rows that must be kept for auditing can be moved to archive tables
+instead, keeping the tables every request hits small.
+
+Rows are processed in small batches selected by primary key ranges, each in
+its own short transaction, so the tables stay available to the requests
+served in the meantime.
+"""
+
+import time
+from django.db import transaction
+from django.db.models import Q
+from ..utils import now
+from .models import AccessToken, RefreshToken, Grant
+from .models import ArchivedAccessToken, ArchivedRefreshToken, ArchivedGrant
+
+
+def expired_refresh_tokens():
+    return RefreshToken._base_manager.filter(expired=True)
+
+
+def expired_access_tokens(reference=None):
+    """
+    Expired or revoked access tokens that can't be refreshed anymore.
+    Expired tokens with a usable refresh token are needed to refresh them.
+    """
+    if reference is None:
+        reference = now()
+    return AccessToken.all_objects.filter(
+        Q(refresh_token__isnull=True) | Q(refresh_token__expired=True),
+        Q(expires__lte=reference) | Q(is_deleted=True))
+
+
+def expired_grants(reference=None):
+    if reference is None:
+        reference = now()
+    return Grant._base_manager.filter(expires__lte=reference)
+
+
+def expired(reference=None):
+    """
+    Return the querysets of expired rows in the order they should be
+    processed: refresh tokens first, as they keep their access tokens alive.
+    """
+    return [
+        expired_refresh_tokens(),
+        expired_access_tokens(reference),
+        expired_grants(reference),
+    ]
+
+
+def batches(queryset, batch_size):
+    """
+    Yield the primary keys of ``queryset`` in lists of at most
+    ``batch_size``. Each batch is queried after the previous one was
+    handled, starting past its last key.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+
+    while True:
+        page = queryset if last_pk is None else \
+            queryset.filter(pk__gt=last_pk)
+        pks = list(page.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+        last_pk = pks[-1]
+
+
+def _process(queryset, batch_size, sleep, handle):
+    first = True
+    for pks in batches(queryset, batch_size):
+        if not first and sleep:
+            time.sleep(sleep)
+        first = False
+        with transaction.atomic():
+            # Filtering again skips rows that no longer match since the
+            # batch was selected
+            pks = list(queryset.filter(pk__in=pks).values_list('pk',
+                flat=True))
+            handle(queryset.model, pks)
+        yield len(pks)
+
+
+def _delete(model, pks):
+    # Deleting through the ORM runs the receivers that evict the tokens from
+    # the caches
+    model._base_manager.filter(pk__in=pks).delete()
+
+
+def purge(queryset, batch_size=1000, sleep=0):
+    """
+    Delete the rows of ``queryset`` batch by batch, yielding the number of
+    rows deleted by each batch and sleeping ``sleep`` seconds in between.
+    """
+    return _process(queryset, batch_size, sleep, _delete)
+
+
+ARCHIVES = {
+    Grant: ArchivedGrant,
+    AccessToken: ArchivedAccessToken,
+    RefreshToken: ArchivedRefreshToken,
+}
+"""
+The archive model of each model.
+"""
+
+
+def _move(model, pks):
+    if model is AccessToken:
+        # Deleting access tokens would take their refresh tokens along
+        _move(RefreshToken, list(RefreshToken._base_manager.filter(
+            access_token__in=pks).values_list('pk', flat=True)))
+
+    archive_model = ARCHIVES[model]
+    fields = [field.attname for field in archive_model._meta.concrete_fields
+        if field.attname != 'archived_at']
+    rows = model._base_manager.filter(pk__in=pks).values_list(*fields)
+    archive_model.objects.bulk_create(archive_model(**dict(zip(fields, row)))
+        for row in rows.iterator())
+    _delete(model, pks)
+
+
+def archive(queryset, batch_size=1000, sleep=0):
+    """
+    Like :func:`purge`, but copy the rows into their archive model in the
+    same transaction they are deleted in, see :attr:`ARCHIVES`.
+    """
+    return _process(queryset, batch_size, sleep, _move)
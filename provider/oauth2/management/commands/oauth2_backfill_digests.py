@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from ... import indexes
+from ...models import AccessToken, RefreshToken, Grant
+from ....utils import token_digest
+
+
+class Command(BaseCommand):
+    help = ("Fill in the digest columns of access tokens, refresh tokens and "
+            "grants saved before they existed and index them. Run before "
+            "setting OAUTH_TOKEN_DIGESTS.")
+
+    columns = (
+        (AccessToken, 'token'),
+        (RefreshToken, 'token'),
+        (Grant, 'code'),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of rows updated per transaction.")
+
+    def handle(self, *args, **options):
+        for model, field in self.columns:
+            count = self.backfill(model, field, options['batch_size'])
+            self.stdout.write("%s: %d digests filled in" % (
+                model._meta.verbose_name_plural, count))
+
+        with connection.schema_editor() as schema_editor:
+            for name in indexes.create_indexes(schema_editor, indexes.DIGEST):
+                self.stdout.write("%s created" % name)
+
+    def backfill(self, model, field, batch_size):
+        digest_field = '%s_digest' % field
+        missing = model._base_manager.filter(**{
+            '%s__isnull' % digest_field: True}).order_by('pk')
+        count, last_pk = 0, 0
+
+        while True:
+            rows = list(missing.filter(pk__gt=last_pk).values_list('pk',
+                field)[:batch_size])
+            if not rows:
+                return count
+
+            with transaction.atomic():
+                for pk, value in rows:
+                    model._base_manager.filter(pk=pk).update(**{
+                        digest_field: token_digest(value)})
+
+            count += len(rows)
+            last_pk = rows[-1][0]
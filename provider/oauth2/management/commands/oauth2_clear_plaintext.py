@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from .... import constants
+from ... import indexes
+from ...models import AccessToken, RefreshToken, Grant
+
+
+class Command(BaseCommand):
+    help = ("Empty the plaintext columns of access tokens, refresh tokens and "
+            "grants and drop their indexes, leaving only the digests. Run "
+            "after oauth2_backfill_digests, once OAUTH_TOKEN_DIGESTS is set "
+            "and OAUTH_TOKEN_PLAINTEXT is False.")
+
+    columns = (
+        (AccessToken, 'token'),
+        (RefreshToken, 'token'),
+        (Grant, 'code'),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of rows updated per statement.")
+
+    def handle(self, *args, **options):
+        if not constants.TOKEN_DIGESTS or constants.TOKEN_PLAINTEXT:
+            raise CommandError("Set OAUTH_TOKEN_DIGESTS and "
+                "OAUTH_TOKEN_PLAINTEXT = False first, tokens are still "
+                "looked up or saved by their plaintext.")
+
+        for model, field in self.columns:
+            if model._base_manager.filter(**{
+                    '%s_digest__isnull' % field: True}).exists():
+                raise CommandError("Some %s have no digest, run "
+                    "oauth2_backfill_digests first." %
+                    model._meta.verbose_name_plural)
+
+        for model, field in self.columns:
+            count = self.clear(model, field, options['batch_size'])
+            self.stdout.write("%s: %d cleared" % (
+                model._meta.verbose_name_plural, count))
+
+        with connection.schema_editor() as schema_editor:
+            for name in indexes.drop_indexes(schema_editor,
+                    indexes.PLAINTEXT):
+                self.stdout.write("%s dropped" % name)
+
+    def clear(self, model, field, batch_size):
+        stored = model._base_manager.exclude(**{field: ''}).order_by('pk')
+        count = 0
+
+        while True:
+            pks = list(stored.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return count
+            count += model._base_manager.filter(pk__in=pks).update(**{
+                field: ''})
@@ -0,0 +1,45 @@
+from timeit import default_timer
+from django.core.management.base import BaseCommand
+from ... import maintenance
+
+
+class Command(BaseCommand):
+    help = ("Delete or archive expired refresh tokens, access tokens and "
+            "grants in small batches. Access tokens are kept as long as "
+            "they can still be refreshed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of rows deleted per transaction.")
+        parser.add_argument('--sleep', type=float, default=0,
+            help="Seconds to wait between batches.")
+        parser.add_argument('--archive', action='store_true', default=False,
+            help="Move the rows to the archive tables instead of deleting "
+                 "them.")
+
+    def handle(self, *args, **options):
+        if options['archive']:
+            process, action = maintenance.archive, 'archived'
+        else:
+            process, action = maintenance.purge, 'deleted'
+
+        for queryset in maintenance.expired():
+            self.run(queryset, process(queryset, options['batch_size'],
+                options['sleep']), action, options['verbosity'])
+
+    def run(self, queryset, batches, action, verbosity):
+        name = queryset.model._meta.verbose_name_plural
+        started = default_timer()
+        total = 0
+
+        for count in batches:
+            total += count
+            if verbosity > 0:
+                elapsed = default_timer() - started
+                self.stdout.write("%s: %d %s, %.1f rows/s" % (name, total,
+                    action, total / elapsed if elapsed else 0))
+
+        if verbosity > 0:
+            elapsed = default_timer() - started
+            self.stdout.write("%s: %d %s in %.1fs, %.1f rows/s" % (name,
+                total, action, elapsed, total / elapsed if elapsed else 0))
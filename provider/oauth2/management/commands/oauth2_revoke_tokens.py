@@ -0,0 +1,50 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from .... import scope as scopes
+from ...models import AccessToken, Client
+
+
+class Command(BaseCommand):
+    help = ("Revoke the access and refresh tokens of a user, of a client or "
+            "granting any of the given scopes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user',
+            help="Username of the user whose tokens to revoke.")
+        parser.add_argument('--client',
+            help="client_id of the client whose tokens to revoke.")
+        parser.add_argument('--scope',
+            help="Space separated names of the scopes whose tokens to "
+                 "revoke.")
+
+    def handle(self, *args, **options):
+        criteria = {}
+
+        if options['user']:
+            User = get_user_model()
+            try:
+                criteria['user'] = User.objects.get_by_natural_key(
+                    options['user'])
+            except User.DoesNotExist:
+                raise CommandError("Unknown user %r." % options['user'])
+
+        if options['client']:
+            try:
+                criteria['client'] = Client.objects.get(
+                    client_id=options['client'])
+            except Client.DoesNotExist:
+                raise CommandError("Unknown client %r." % options['client'])
+
+        if options['scope']:
+            names = options['scope'].split()
+            unknown = [name for name in names
+                if name not in scopes.SCOPE_NAME_DICT]
+            if unknown:
+                raise CommandError("Unknown scopes: %s." % ', '.join(unknown))
+            criteria['scope'] = scopes.to_int(*names)
+
+        if not criteria:
+            raise CommandError("Pass --user, --client or --scope.")
+
+        count = AccessToken.objects.revoke_for(**criteria)
+        self.stdout.write("%d access tokens revoked" % count)
@@ -1,7 +1,237 @@
-from ..utils import now
-from django.db import models
+from datetime import timedelta
+from itertools import islice
+from ..utils import now, token_digest, long_token, signed_token
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models, transaction
+from .. import constants
+from . import cache
 
 
-class AccessTokenManager(models.Manager):
+def lookup(field, value):
+    """
+    Return the filter arguments matching the token or code ``field`` against
+    ``value``. Goes by the binary digest column of ``field`` when
+    :attr:`provider.constants.TOKEN_DIGESTS` is set.
+    """
+    if constants.TOKEN_DIGESTS:
+        return {'%s_digest' % field: token_digest(value)}
+    return {field: value}
+
+
+def check_plaintext():
+    """
+    Raise :class:`django.core.exceptions.ImproperlyConfigured` if tokens are
+    saved without their plaintext but are still looked up by it, or a
+    setting needs the plaintext of tokens read back from the database.
+    """
+    if constants.TOKEN_PLAINTEXT:
+        return
+    if not constants.TOKEN_DIGESTS:
+        raise ImproperlyConfigured("OAUTH_TOKEN_PLAINTEXT = False requires "
+            "OAUTH_TOKEN_DIGESTS.")
+    for setting in ('SIGNED_TOKENS', 'SINGLE_ACCESS_TOKEN'):
+        if getattr(constants, setting):
+            raise ImproperlyConfigured("OAUTH_%s can't be combined with "
+                "OAUTH_TOKEN_PLAINTEXT = False, it needs the plaintext of "
+                "stored tokens." % setting)
+
+
+class AccessTokenQuerySet(models.QuerySet):
+    def revoke(self, batch_size=1000):
+        """
+        Soft delete the access tokens by setting their ``is_deleted`` flag
+        and expire their refresh tokens, with one UPDATE per model and batch
+        of ``batch_size`` tokens. The tokens are evicted from the caches.
+        Returns the number of access tokens revoked.
+        """
+        from .models import RefreshToken
+
+        tokens = self.filter(is_deleted=False).only('token', 'token_digest',
+            'expires').order_by('pk')
+        count, last_pk = 0, 0
+
+        while True:
+            revoked = list(tokens.filter(pk__gt=last_pk)[:batch_size])
+            if not revoked:
+                return count
+            pks = [access_token.pk for access_token in revoked]
+
+            with transaction.atomic(using=self.db):
+                count += self.model.all_objects.filter(pk__in=pks,
+                    is_deleted=False).update(is_deleted=True)
+                RefreshToken.objects.filter(access_token__in=pks,
+                    expired=False).update(expired=True)
+
+            # UPDATE sends no signals, do what the receivers would have done
+            for access_token in revoked:
+                cache.evict(access_token)
+
+            if len(revoked) < batch_size:
+                return count
+            last_pk = pks[-1]
+
+    def revoke_for(self, user=None, client=None, scope=None):
+        """
+        Revoke the access and refresh tokens of ``user``, of ``client`` and
+        granting any of the ``scope`` bits, whichever are given. Returns the
+        number of access tokens revoked.
+        """
+        from .models import RefreshToken
+
+        filters = dict((name, value) for name, value in (('user', user),
+            ('client', client)) if value is not None)
+        if not filters and scope is None:
+            raise ValueError("Pass a user, a client or a scope.")
+
+        if scope is not None:
+            filters['scope__has_any'] = scope
+        access_tokens = self.model.all_objects.filter(**filters)
+
+        count = self.filter(pk__in=access_tokens.values('pk')).revoke()
+        # Refresh tokens whose access token was revoked or expired before
+        RefreshToken.objects.filter(expired=False,
+            access_token__in=access_tokens.values('pk')).update(expired=True)
+        return count
+
+
+class AccessTokenManager(models.Manager.from_queryset(AccessTokenQuerySet)):
+    """
+    Manager leaving out soft deleted access tokens, see
+    :meth:`AccessTokenQuerySet.revoke`.
+    """
+
+    def get_queryset(self):
+        return super(AccessTokenManager, self).get_queryset().filter(
+            is_deleted=False)
+
+    def bulk_issue(self, grants, refresh=True, batch_size=500):
+        """
+        Issue an access token for each ``(user, client, scope)`` tuple of
+        ``grants`` and, unless ``refresh`` is ``False``, a refresh token for
+        each of them. Tokens are inserted ``batch_size`` at a time with a
+        couple of bulk INSERTs per batch, each batch in its own transaction.
+
+        Returns the access tokens, each with its :attr:`refresh_token` set.
+        As no signals are sent, the caches are updated here.
+        """
+        from .models import RefreshToken
+
+        grants = iter(grants)
+        expiries = {}
+        issued = []
+
+        while True:
+            batch = list(islice(grants, batch_size))
+            if not batch:
+                return issued
+
+            access_tokens = []
+            for user, client, scope in batch:
+                # Expiries only depend on the type of the client
+                if client.client_type not in expiries:
+                    expires = client.get_default_token_expiry()
+                    if constants.SIGNED_TOKENS:
+                        expires = expires.replace(microsecond=0)
+                    expiries[client.client_type] = expires
+                expires = expiries[client.client_type]
+
+                if constants.SIGNED_TOKENS:
+                    token = signed_token(user.pk, client.pk, scope, expires)
+                else:
+                    token = long_token()
+                access_tokens.append(self.model(user=user, client=client,
+                    scope=scope, expires=expires, token=token,
+                    token_digest=token_digest(token)))
+
+            with transaction.atomic(using=self.db):
+                access_tokens = self.bulk_create(access_tokens)
+                if refresh:
+                    # Only some backends return the primary keys
+                    if access_tokens[0].pk is None:
+                        self._fetch_pks(access_tokens)
+                    refresh_tokens = []
+                    for access_token in access_tokens:
+                        refresh_token = RefreshToken(user=access_token.user,
+                            access_token=access_token,
+                            client=access_token.client)
+                        refresh_token.token_digest = token_digest(
+                            refresh_token.token)
+                        refresh_tokens.append(refresh_token)
+                        access_token.refresh_token = refresh_token
+                    RefreshToken.objects.bulk_create(refresh_tokens)
+
+            for access_token in access_tokens:
+                cache.rejected.delete(('access', access_token.token))
+                cache.live_tokens.add(access_token.token)
+            issued.extend(access_tokens)
+
+    def _fetch_pks(self, access_tokens):
+        field = 'token_digest' if constants.TOKEN_DIGESTS else 'token'
+        pks = dict(self.filter(**{'%s__in' % field: [getattr(access_token,
+            field) for access_token in access_tokens]}).values_list(field,
+            'pk'))
+        for access_token in access_tokens:
+            access_token.pk = pks[getattr(access_token, field)]
+
     def get_token(self, token):
-        return self.get(token=token, expires__gt=now())
+        """
+        Return the unexpired access token for ``token``, going through
+        :attr:`provider.oauth2.cache.tokens` first.
+        """
+        access_token = cache.tokens.get(token)
+        if access_token is None:
+            access_token = self.resolve(token)
+            cache.tokens.set(access_token)
+        return access_token
+
+    def resolve(self, token, **kwargs):
+        """
+        Return the unexpired access token for ``token`` with its user and
+        client loaded by the same query. Additional ``kwargs`` narrow down the
+        lookup.
+
+        :raises: :attr:`DoesNotExist` if no matching token is found.
+        """
+        kwargs.update(lookup('token', token))
+        access_token = self.select_related('user', 'client').get(
+            expires__gt=now(), **kwargs)
+        # Rows saved without their plaintext only have the digest
+        access_token.token = token
+        return access_token
+
+
+class ClientManager(models.Manager):
+    def get_client(self, client_id):
+        """
+        Return the client for ``client_id``, going through
+        :attr:`provider.oauth2.cache.clients` first.
+
+        :raises: :attr:`DoesNotExist` if no matching client is found.
+        """
+        client = cache.clients.get(client_id)
+        if client is None:
+            # Taken before the query, a change in between leaves the entry
+            # stale instead of current
+            version = cache.clients.version(client_id)
+            client = self.get(client_id=client_id)
+            cache.clients.set(client, version)
+        return client
+
+
+class GrantManager(models.Manager):
+    def consume(self, client, code):
+        """
+        Invalidate the unexpired grant of ``client`` for ``code`` with a
+        single conditional DELETE or UPDATE, depending on
+        :attr:`provider.constants.DELETE_EXPIRED`.
+
+        Returns ``True`` if this call invalidated the grant. The database
+        reports the affected rows atomically, so of concurrent calls for the
+        same code exactly one gets ``True``.
+        """
+        grants = self.filter(client=client, expires__gt=now(),
+            **lookup('code', code))
+        if constants.DELETE_EXPIRED:
+            deleted, _ = grants.delete()
+            return deleted > 0
+        return grants.update(expires=now() - timedelta(days=1)) > 0
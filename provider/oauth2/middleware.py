@@ -1,9 +1,13 @@
+from timeit import default_timer
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.http.response import HttpResponse
 from django.utils.functional import SimpleLazyObject
-from django.utils.timezone import now
+from django.utils.module_loading import import_string
+from provider import constants
 from provider.oauth2.models import AccessToken
+from provider.oauth2 import cache, instrumentation
+from provider.utils import now, read_signed_token
 
 __author__ = 'amaru'
 
@@ -11,48 +15,131 @@ class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
 
 
-def _get_user(request):
-    oauth_token = None
+_extractors = {}
+
+
+def get_extractors():
+    """
+    Return the functions configured in
+    :attr:`provider.constants.TOKEN_EXTRACTORS`.
+    """
+    paths = tuple(constants.TOKEN_EXTRACTORS)
     try:
-        auth_header = request.META['HTTP_AUTHORIZATION']
-        if auth_header.startswith('token'):
-            try:
-                oauth_token = auth_header.split(' ')[1]
-            except IndexError:
-                return AnonymousUser()
+        return _extractors[paths]
     except KeyError:
-        pass
+        _extractors[paths] = [import_string(path) for path in paths]
+        return _extractors[paths]
 
-    if not oauth_token:
-        try:
-            oauth_token = request.GET['access_token']
-        except KeyError:
-            pass
 
-    if not oauth_token:
-        try:
-            oauth_token = request.POST['access_token']
-        except KeyError:
-            pass
+def extract_token(request):
+    """
+    Run the extractors over ``request`` and return a ``(source, token)``
+    tuple, ``source`` being the name of the extractor that found the token.
+    Returns ``(None, None)`` if none did.
+    """
+    for extractor in get_extractors():
+        token = extractor(request)
+        if token is not None:
+            return extractor.__name__, token or None
+    return None, None
 
-    if not oauth_token:
-        try:
-            oauth_token = request.COOKIES['at']
-        except KeyError:
-            pass
 
-    if not oauth_token:
+def get_token(request):
+    """
+    Return the valid access token the request was made with, or ``None``.
+    The token is resolved once per request.
+    """
+    if not hasattr(request, '_cached_oauth_token'):
+        sinks = instrumentation.get_sinks()
+        if sinks:
+            started = default_timer()
+
+        source, oauth_token = extract_token(request)
+        if oauth_token:
+            outcome, token = _resolve_token(oauth_token)
+        else:
+            outcome, token = instrumentation.NO_TOKEN, None
+        request._cached_oauth_token = token
+
+        if sinks:
+            instrumentation.record(sinks, source, outcome,
+                default_timer() - started)
+    return request._cached_oauth_token
+
+
+def _get_user(request):
+    token = get_token(request)
+    if token is None:
         return AnonymousUser()
+    return token.user
+
+
+def resolve_token(oauth_token):
+    """
+    Return the valid access token for the token string ``oauth_token`` with
+    its user loaded, or ``None``. Goes through the caches in
+    :attr:`provider.oauth2.cache` before the database.
+    """
+    return _resolve_token(oauth_token)[1]
+
+
+def _resolve_token(oauth_token):
+    """
+    :func:`resolve_token` returning an ``(outcome, token)`` tuple, see
+    :attr:`provider.oauth2.instrumentation` for the outcomes.
+    """
+    if cache.rejected.get(('access', oauth_token)):
+        return instrumentation.KNOWN_INVALID, None
+
+    if constants.SIGNED_TOKENS:
+        payload = read_signed_token(oauth_token)
+        if payload is not None:
+            return _resolve_signed_token(oauth_token, payload)
+
+    token = cache.tokens.get(oauth_token)
+    if token is not None:
+        if token.user is None or not token.user.is_active:
+            return instrumentation.INACTIVE_USER, None
+        return instrumentation.CACHED, token
+
+    if not cache.live_tokens.might_contain(oauth_token):
+        cache.rejected.set(('access', oauth_token), True)
+        return instrumentation.FILTERED, None
 
     try:
-        token = AccessToken.objects.get(token=oauth_token, expires__gt=now(), user__is_active=True)
+        token = AccessToken.objects.resolve(oauth_token, user__is_active=True)
     except AccessToken.DoesNotExist:
-        return AnonymousUser()
+        cache.rejected.set(('access', oauth_token), True)
+        return instrumentation.NOT_FOUND, None
 
-    try:
-        return get_user_model().objects.get(pk=token.user_id)
-    except get_user_model().DoesNotExist:
-        return AnonymousUser()
+    cache.tokens.set(token)
+    return instrumentation.LOADED, token
+
+
+def _resolve_signed_token(oauth_token, payload):
+    """
+    Verify a signed token without looking it up. Only its user is loaded,
+    and only if the token cache doesn't hold it already.
+    """
+    if payload['expires'] <= now():
+        return instrumentation.EXPIRED, None
+    if cache.revoked.is_revoked(oauth_token):
+        return instrumentation.REVOKED, None
+
+    token = cache.tokens.get(oauth_token)
+    if token is None:
+        User = get_user_model()
+        try:
+            user = User.objects.get(pk=payload['user_id'], is_active=True)
+        except User.DoesNotExist:
+            return instrumentation.INACTIVE_USER, None
+        token = AccessToken(token=oauth_token, user=user,
+            client_id=payload['client_id'], scope=payload['scope'],
+            expires=payload['expires'])
+        cache.tokens.set(token)
+    elif not token.user.is_active:
+        return instrumentation.INACTIVE_USER, None
+    return instrumentation.SIGNED, token
 
 
 def get_user(request):
@@ -64,17 +151,24 @@ def get_user(request):
 class AuthenticationMiddleware(object):
     """
     Checks the incoming requests for a valid authentication mechanism.
-    Authentication mechanisms allowed are (in order of preference):
-    1. Header: "Authorization: token <OAUTH-TOKEN>"
-    2. Http params: "access_token=<OAUTH-TOKEN>"
-    3. (Unsupported) Header: "Authorization: client_id <ID> client_secret <SECRET>" // public requests where user isn't
+    Authentication mechanisms allowed by default are (in order of preference):
+    1. Header: "Authorization: Bearer <OAUTH-TOKEN>" or "Authorization: token <OAUTH-TOKEN>"
+    2. Query string: "access_token=<OAUTH-TOKEN>"
+    3. Cookie: at=<OAUTH-TOKEN>
+    4. Form encoded body: "access_token=<OAUTH-TOKEN>", up to OAUTH_BODY_TOKEN_MAX_SIZE bytes
+    5. (Unsupported) Header: "Authorization: client_id <ID> client_secret <SECRET>" // public requests where user isn't
     required
-    4. (Unsupported) Http params: "client_id=<ID>&client_secret=<SECRET>" // public requests where user isn't required
-    5. Cookie: at=<OAUTH-TOKEN>
+    6. (Unsupported) Http params: "client_id=<ID>&client_secret=<SECRET>" // public requests where user isn't required
+
+    The mechanisms are configured through OAUTH_TOKEN_EXTRACTORS, see provider.oauth2.extractors.
 
     If a path requires an authenticated user, and none is presented, the method would return 401 access denied.
+
+    The access token is available as request.oauth_token, loaded by the same lookup as request.user. It evaluates
+    as false if the request carries no valid token. See provider.oauth2.decorators to require scopes.
     """
 
     def process_request(self, request):
         request.user = SimpleLazyObject(lambda: get_user(request))
+        request.oauth_token = SimpleLazyObject(lambda: get_token(request))
         return None
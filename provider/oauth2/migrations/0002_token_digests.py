@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 01:27
+from __future__ import unicode_literals
+
+from django.db import migrations
+import provider.oauth2.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='token_digest',
+            field=provider.oauth2.models.DigestField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='grant',
+            name='code_digest',
+            field=provider.oauth2.models.DigestField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refreshtoken',
+            name='token_digest',
+            field=provider.oauth2.models.DigestField(db_index=True, null=True),
+        ),
+    ]
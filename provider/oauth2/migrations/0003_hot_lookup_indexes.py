@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 01:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import provider.oauth2.models
+import provider.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0002_token_digests'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='client',
+            name='client_id',
+            field=models.CharField(default=provider.utils.short_token, max_length=255, unique=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='accesstoken',
+            index_together=set([('token', 'expires', 'user'), ('token_digest', 'expires', 'user'), ('user', 'client', 'scope', 'expires')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='grant',
+            index_together=set([('code', 'client', 'expires'), ('code_digest', 'client', 'expires')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='refreshtoken',
+            index_together=set([('token', 'client', 'expired'), ('token_digest', 'client', 'expired')]),
+        ),
+        # Drop the single column indexes once the composite ones exist
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='token',
+            field=models.CharField(default=provider.utils.long_token, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='token_digest',
+            field=provider.oauth2.models.DigestField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='grant',
+            name='code_digest',
+            field=provider.oauth2.models.DigestField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='refreshtoken',
+            name='token_digest',
+            field=provider.oauth2.models.DigestField(null=True),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 01:34
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import provider.oauth2.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('oauth2', '0003_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAccessToken',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('token', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField()),
+                ('expires', models.DateTimeField()),
+                ('scope', provider.oauth2.models.ScopeField(choices=[(2, b'read'), (4, b'write')], default=0)),
+                ('type', models.IntegerField(default=0)),
+                ('is_deleted', models.BooleanField(default=False)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('client', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='oauth2.Client')),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedGrant',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('code', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField()),
+                ('expires', models.DateTimeField()),
+                ('redirect_uri', models.CharField(blank=True, max_length=255)),
+                ('scope', provider.oauth2.models.ScopeField(choices=[(2, b'read'), (4, b'write')], default=0)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('client', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='oauth2.Client')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedRefreshToken',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('token', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField()),
+                ('expired', models.BooleanField(default=False)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('access_token', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='oauth2.ArchivedAccessToken')),
+                ('client', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='oauth2.Client')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
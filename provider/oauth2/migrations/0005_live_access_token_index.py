@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Partial indexes only hold the access tokens that haven't been revoked, the
+# only ones AccessToken.objects looks up. Only PostgreSQL and SQLite support
+# them, other backends make do with the composite indexes.
+INDEXES = (
+    ('oauth2_accesstoken_live_token', ('token', 'expires', 'user_id')),
+    ('oauth2_accesstoken_live_digest', ('token_digest', 'expires', 'user_id')),
+)
+
+FALSE = {
+    'postgresql': 'false',
+    'sqlite': '0',
+}
+
+
+def create_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in FALSE:
+        return
+    quote = schema_editor.quote_name
+    for name, columns in INDEXES:
+        schema_editor.execute('CREATE INDEX %s ON %s (%s) WHERE %s = %s' % (
+            quote(name), quote('oauth2_accesstoken'),
+            ', '.join(quote(column) for column in columns),
+            quote('is_deleted'), FALSE[vendor]))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in FALSE:
+        return
+    for name, columns in INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % (
+            schema_editor.quote_name(name),))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0004_archives'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
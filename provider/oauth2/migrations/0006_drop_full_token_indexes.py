@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# The partial indexes of 0005 answer every lookup the full composite ones of
+# 0003 did, so the latter are dropped where the former exist. Other backends
+# keep the composite ones, which are no longer part of the model state.
+PARTIAL_INDEXES = {
+    ('token', 'expires', 'user_id'): 'oauth2_accesstoken_live_token',
+    ('token_digest', 'expires', 'user_id'): 'oauth2_accesstoken_live_digest',
+}
+
+VENDORS = ('postgresql', 'sqlite')
+
+TABLE = 'oauth2_accesstoken'
+
+
+def drop_full_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor not in VENDORS:
+        return
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, TABLE)
+    for name, constraint in constraints.items():
+        partial = PARTIAL_INDEXES.get(tuple(constraint['columns']))
+        if partial is None or name == partial or not constraint['index'] \
+                or constraint['unique'] or constraint['primary_key']:
+            continue
+        schema_editor.execute(schema_editor.sql_delete_index % {
+            'name': schema_editor.quote_name(name),
+            'table': schema_editor.quote_name(TABLE),
+        })
+
+
+def create_full_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in VENDORS:
+        return
+    quote = schema_editor.quote_name
+    for columns, partial in PARTIAL_INDEXES.items():
+        schema_editor.execute(schema_editor.sql_create_index % {
+            'name': quote(partial.replace('_live_', '_full_')),
+            'table': quote(TABLE),
+            'columns': ', '.join(quote(column) for column in columns),
+            'extra': '',
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0005_live_access_token_index'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(drop_full_indexes, create_full_indexes),
+            ],
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='accesstoken',
+                    index_together=set([('user', 'client', 'scope', 'expires')]),
+                ),
+            ],
+        ),
+    ]
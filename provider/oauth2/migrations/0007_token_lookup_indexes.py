@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 02:18
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+import provider.oauth2.models
+import provider.utils
+from provider.oauth2 import indexes
+
+# The token and code lookup indexes are left to provider.oauth2.indexes. The
+# plaintext ones stay; the digest ones are only kept if digests are in use.
+
+
+def drop_digest_indexes(apps, schema_editor):
+    if not getattr(settings, 'OAUTH_TOKEN_DIGESTS', False):
+        indexes.drop_indexes(schema_editor, indexes.DIGEST)
+
+
+def create_digest_indexes(apps, schema_editor):
+    indexes.create_indexes(schema_editor, indexes.DIGEST)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0006_drop_full_token_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(drop_digest_indexes,
+                    create_digest_indexes),
+            ],
+            state_operations=[
+                # Only saves differently, the columns stay the same
+                migrations.AlterField(
+                    model_name='accesstoken',
+                    name='token',
+                    field=provider.oauth2.models.TokenField(default=provider.utils.long_token, max_length=255),
+                ),
+                migrations.AlterField(
+                    model_name='grant',
+                    name='code',
+                    field=provider.oauth2.models.TokenField(default=provider.utils.long_token, max_length=255),
+                ),
+                migrations.AlterField(
+                    model_name='refreshtoken',
+                    name='token',
+                    field=provider.oauth2.models.TokenField(default=provider.utils.long_token, max_length=255),
+                ),
+                migrations.AlterIndexTogether(
+                    name='grant',
+                    index_together=set([]),
+                ),
+                migrations.AlterIndexTogether(
+                    name='refreshtoken',
+                    index_together=set([]),
+                ),
+            ],
+        ),
+    ]
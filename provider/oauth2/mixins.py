@@ -0,0 +1,31 @@
+"""
+Class based view counterparts of :mod:`provider.oauth2.decorators`.
+"""
+
+from .decorators import required_scope, scope_denied
+
+
+class ScopeRequiredMixin(object):
+    """
+    Require the access token of a request to grant all of
+    :attr:`required_scopes`, as :func:`provider.oauth2.decorators.scope_required`
+    does for function based views.
+
+    ::
+
+        class ProfileView(ScopeRequiredMixin, View):
+            required_scopes = ('read',)
+    """
+
+    required_scopes = ()
+
+    def get_required_scopes(self):
+        return self.required_scopes
+
+    def dispatch(self, request, *args, **kwargs):
+        response = scope_denied(request,
+            required_scope(*self.get_required_scopes()))
+        if response is not None:
+            return response
+        return super(ScopeRequiredMixin, self).dispatch(request, *args,
+            **kwargs)
@@ -12,7 +12,9 @@ from .. import constants
 from ..constants import CLIENT_TYPES
 from ..utils import now, short_token, long_token, get_code_expiry
 from ..utils import get_token_expiry, serialize_instance, deserialize_instance
-from .managers import AccessTokenManager
+from ..utils import token_digest
+from .managers import AccessTokenManager, AccessTokenQuerySet, GrantManager
+from .managers import ClientManager
 from .. import scope
 
 try:
@@ -73,6 +75,86 @@ class ScopeField(models.IntegerField):
     def __str__(self):
         return 'scope'
 
+class ScopeLookup(models.Lookup):
+    """
+    Compares the bitwise AND of a :class:`ScopeField` and a scope mask in the
+    database, see :meth:`provider.scope.check`.
+    """
+    def get_prep_lookup(self):
+        # Masks are prepared like any integer compared to the column
+        return self.lhs.output_field.get_prep_lookup('exact', self.rhs)
+
+    def get_db_prep_lookup(self, value, connection):
+        return ('%s', self.lhs.output_field.get_db_prep_lookup('exact', value,
+            connection, prepared=True))
+
+    def as_sql(self, compiler, connection, bitand='(%s & %s)'):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        comparison, comparison_params = self.compare(rhs, rhs_params)
+        return '%s %s' % (bitand % (lhs, rhs), comparison), \
+            lhs_params + rhs_params + comparison_params
+
+    def as_oracle(self, compiler, connection):
+        # Oracle has no bitwise operators
+        return self.as_sql(compiler, connection, bitand='BITAND(%s, %s)')
+
+
+@ScopeField.register_lookup
+class HasAll(ScopeLookup):
+    """
+    ``scope__has_all=mask`` matches scopes including all bits of ``mask``.
+    """
+    lookup_name = 'has_all'
+
+    def compare(self, rhs, rhs_params):
+        return '= %s' % rhs, rhs_params
+
+
+@ScopeField.register_lookup
+class HasAny(ScopeLookup):
+    """
+    ``scope__has_any=mask`` matches scopes including any bit of ``mask``.
+    """
+    lookup_name = 'has_any'
+
+    def compare(self, rhs, rhs_params):
+        return '<> 0', []
+
+class DigestField(models.BinaryField):
+    """
+    Fixed width binary column holding the :func:`provider.utils.token_digest`
+    of a token, giving a far more compact index than the token string.
+    """
+    length = 32
+
+    def db_type(self, connection):
+        if connection.vendor == 'mysql':
+            return 'binary(%d)' % self.length
+        if connection.vendor == 'oracle':
+            return 'RAW(%d)' % self.length
+        return super(DigestField, self).db_type(connection)
+
+    def from_db_value(self, value, expression, connection, context):
+        # Backends return buffers, which can't be pickled into caches
+        if value is not None:
+            return bytes(value)
+        return value
+
+
+class TokenField(models.CharField):
+    """
+    Column holding a token or code in plaintext, next to its
+    :class:`DigestField`. It is left empty when
+    :attr:`provider.constants.TOKEN_PLAINTEXT` is off; the instance keeps its
+    value, but rows read back only have their digest.
+    """
+
+    def pre_save(self, model_instance, add):
+        if not constants.TOKEN_PLAINTEXT:
+            return ''
+        return super(TokenField, self).pre_save(model_instance, add)
+
 def client_logo_image_path(instance, filename):
     filename_split = os.path.splitext(filename)
     ext = filename_split[1]
@@ -110,12 +192,15 @@ class Client(models.Model):
     status = models.PositiveSmallIntegerField(choices=ClientStatus.CHOICES, default=1)
     last_updated_date = models.DateTimeField(auto_now=True)
     created_date = models.DateTimeField(auto_now_add=True)
-    client_id = models.CharField(max_length=255, default=short_token)
+    client_id = models.CharField(max_length=255, default=short_token,
+        unique=True)
     client_secret = models.CharField(max_length=255, default=long_token)
     client_type = models.IntegerField(choices=CLIENT_TYPES, default=constants.CONFIDENTIAL)
     scope = ScopeField(default=0)
     event_delivery_preference = models.PositiveSmallIntegerField(choices=EventDeliveryPreference.CHOICES, default=0)
 
+    objects = ClientManager()
+
     def __unicode__(self):
         return self.redirect_uri
 
@@ -174,15 +259,23 @@ class Grant(models.Model):
     """
     user = models.ForeignKey(AUTH_USER_MODEL)
     client = models.ForeignKey(Client)
-    code = models.CharField(max_length=255, default=long_token)
+    code = TokenField(max_length=255, default=long_token)
+    code_digest = DigestField(null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     expires = models.DateTimeField(default=get_code_expiry)
     redirect_uri = models.CharField(max_length=255, blank=True)
     scope = ScopeField(default=0)
 
+    objects = GrantManager()
+
     def __unicode__(self):
         return self.code
 
+    def save(self, *args, **kwargs):
+        if self.code:
+            self.code_digest = token_digest(self.code)
+        super(Grant, self).save(*args, **kwargs)
+
 class AccessToken(models.Model):
     """
     Default access token implementation. An access token is a time limited
@@ -202,9 +295,13 @@ class AccessToken(models.Model):
 
     * :meth:`get_expire_delta` - returns an integer representing seconds to
         expiry
+
+    Revoked tokens are only flagged as :attr:`is_deleted` and left out by
+    :attr:`objects`; :attr:`all_objects` includes them.
     """
     user = models.ForeignKey(AUTH_USER_MODEL, null=True)
-    token = models.CharField(max_length=255, default=long_token, db_index=True)
+    token = TokenField(max_length=255, default=long_token)
+    token_digest = DigestField(null=True)
     client = models.ForeignKey(Client)
     created_at = models.DateTimeField(auto_now_add=True)
     expires = models.DateTimeField()
@@ -213,6 +310,14 @@ class AccessToken(models.Model):
     is_deleted = models.BooleanField(default=False)
 
     objects = AccessTokenManager()
+    all_objects = AccessTokenQuerySet.as_manager()
+
+    class Meta:
+        # The token lookups are indexed through provider.oauth2.indexes
+        index_together = (
+            # Looking for a token to reuse or an existing authorization
+            ('user', 'client', 'scope', 'expires'),
+        )
 
     def __unicode__(self):
         return self.token
@@ -220,6 +325,8 @@ class AccessToken(models.Model):
     def save(self, *args, **kwargs):
         if not self.expires:
             self.expires = self.client.get_default_token_expiry()
+        if self.token:
+            self.token_digest = token_digest(self.token)
         super(AccessToken, self).save(*args, **kwargs)
 
     def get_expire_delta(self, reference=None):
@@ -256,7 +363,8 @@ class RefreshToken(models.Model):
     * :attr:`expired` - ``boolean``
     """
     user = models.ForeignKey(AUTH_USER_MODEL)
-    token = models.CharField(max_length=255, default=long_token)
+    token = TokenField(max_length=255, default=long_token)
+    token_digest = DigestField(null=True)
     access_token = models.OneToOneField(AccessToken,
             related_name='refresh_token')
     client = models.ForeignKey(Client)
@@ -266,6 +374,74 @@ class RefreshToken(models.Model):
     def __unicode__(self):
         return self.token
 
+    def save(self, *args, **kwargs):
+        if self.token:
+            self.token_digest = token_digest(self.token)
+        super(RefreshToken, self).save(*args, **kwargs)
+
+class ArchivedGrant(models.Model):
+    """
+    Expired :class:`Grant` kept for auditing, see
+    :func:`provider.oauth2.maintenance.archive`. Archived rows keep the
+    primary key they had and don't constrain their user or client.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(AUTH_USER_MODEL, db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='+')
+    client = models.ForeignKey(Client, db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='+')
+    code = models.CharField(max_length=255)
+    created_at = models.DateTimeField()
+    expires = models.DateTimeField()
+    redirect_uri = models.CharField(max_length=255, blank=True)
+    scope = ScopeField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.code
+
+
+class ArchivedAccessToken(models.Model):
+    """
+    Expired :class:`AccessToken` kept for auditing.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(AUTH_USER_MODEL, null=True, db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='+')
+    token = models.CharField(max_length=255)
+    client = models.ForeignKey(Client, db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='+')
+    created_at = models.DateTimeField()
+    expires = models.DateTimeField()
+    scope = ScopeField(default=0)
+    type = models.IntegerField(default=0)
+    is_deleted = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.token
+
+
+class ArchivedRefreshToken(models.Model):
+    """
+    Expired :class:`RefreshToken` kept for auditing. :attr:`access_token` is
+    the primary key of the :class:`ArchivedAccessToken` it refreshed.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(AUTH_USER_MODEL, db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='+')
+    token = models.CharField(max_length=255)
+    access_token = models.ForeignKey(ArchivedAccessToken,
+        db_constraint=False, on_delete=models.DO_NOTHING, related_name='+')
+    client = models.ForeignKey(Client, db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='+')
+    created_at = models.DateTimeField()
+    expired = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.token
+
 """
 Fix for south being unable to introspect custom fields
 https://github.com/pinax/django-user-accounts/issues/61
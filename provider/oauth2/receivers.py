@@ -0,0 +1,63 @@
+"""
+Signal receivers keeping the caches in :attr:`provider.oauth2.cache` in step
+with the database. Connected when the application is ready.
+"""
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from . import cache
+from .models import AccessToken, Client, RefreshToken
+
+
+def _access_token_of(refresh_token):
+    # Only look at an access token that is already loaded. Refresh token
+    # changes don't affect the validity of the access token and must not cost
+    # a query on bulk deletes; changes to the access token itself are covered
+    # by its own receivers.
+    cache_name = RefreshToken._meta.get_field('access_token').get_cache_name()
+    return getattr(refresh_token, cache_name, None)
+
+
+@receiver(post_save, sender=AccessToken, dispatch_uid='oauth2.access_token_saved')
+def access_token_saved(sender, instance, created, **kwargs):
+    if created:
+        cache.rejected.delete(('access', instance.token))
+        cache.live_tokens.add(instance.token)
+    else:
+        cache.tokens.discard(instance)
+
+
+@receiver(post_delete, sender=AccessToken, dispatch_uid='oauth2.access_token_deleted')
+def access_token_deleted(sender, instance, **kwargs):
+    # Signed tokens stay valid without their row, evict revokes them
+    cache.evict(instance)
+
+
+@receiver(post_save, sender=RefreshToken, dispatch_uid='oauth2.refresh_token_saved')
+def refresh_token_saved(sender, instance, created, **kwargs):
+    if created:
+        cache.rejected.delete(('refresh', instance.client_id, instance.token))
+    else:
+        access_token = _access_token_of(instance)
+        if access_token is not None:
+            cache.tokens.discard(access_token)
+
+
+@receiver(post_delete, sender=RefreshToken, dispatch_uid='oauth2.refresh_token_deleted')
+def refresh_token_deleted(sender, instance, **kwargs):
+    access_token = _access_token_of(instance)
+    if access_token is not None:
+        cache.tokens.discard(access_token)
+
+
+@receiver(post_save, sender=Client, dispatch_uid='oauth2.client_saved')
+def client_saved(sender, instance, created, **kwargs):
+    if not created:
+        cache.clients.bump(instance.client_id)
+        cache.clients.delete(instance.client_id)
+
+
+@receiver(post_delete, sender=Client, dispatch_uid='oauth2.client_deleted')
+def client_deleted(sender, instance, **kwargs):
+    cache.clients.bump(instance.client_id)
+    cache.clients.delete(instance.client_id)
@@ -0,0 +1,112 @@
+"""
+Storage of the authorization codes handed out by
+:class:`provider.oauth2.views.Authorize` until they are exchanged for an
+access token. The store in use is configured through
+:attr:`provider.constants.GRANT_STORE`.
+
+A store implements three methods:
+
+``save(grant)``
+    Store the unsaved :class:`provider.oauth2.models.Grant` ``grant``.
+``get(client, code)``
+    Return the unexpired grant of ``client`` for ``code`` or ``None``.
+``consume(grant)``
+    Invalidate ``grant``. Returns ``True`` for exactly one caller, even if
+    several try to consume the grant at once; the others must not issue
+    tokens for it.
+"""
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from .. import constants
+from ..utils import now
+from .cache import _key
+from .managers import lookup
+from .models import Grant
+
+
+class DatabaseGrantStore(object):
+    """
+    Keeps grants in the :class:`provider.oauth2.models.Grant` table.
+    """
+
+    def save(self, grant):
+        grant.save()
+
+    def get(self, client, code):
+        try:
+            grant = Grant.objects.select_related('user').get(client=client,
+                expires__gt=now(), **lookup('code', code))
+        except Grant.DoesNotExist:
+            return None
+        # Rows saved without their plaintext only have the digest
+        grant.code = code
+        return grant
+
+    def consume(self, grant):
+        return Grant.objects.consume(grant.client_id, grant.code)
+
+
+class CacheGrantStore(object):
+    """
+    Keeps grants in the :attr:`provider.constants.GRANT_CACHE_BACKEND` cache
+    until they expire, sparing the database a write and a lookup per
+    authorization. The cache is shared by all nodes and must not evict
+    entries early, or users would have to authorize again.
+
+    Grants kept here have no primary key.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = constants.GRANT_CACHE_BACKEND if backend is None \
+            else backend
+
+    @property
+    def cache(self):
+        return caches[self.backend]
+
+    def save(self, grant):
+        timeout = int((grant.expires - now()).total_seconds())
+        if timeout <= 0:
+            return
+        self.cache.set(_key('grant', grant.code), {
+            'user_id': grant.user_id,
+            'client_id': grant.client_id,
+            'expires': grant.expires,
+            'redirect_uri': grant.redirect_uri,
+            'scope': grant.scope,
+        }, timeout)
+
+    def get(self, client, code):
+        data = self.cache.get(_key('grant', code))
+        if data is None or data['client_id'] != client.pk or \
+                data['expires'] <= now():
+            return None
+        return Grant(code=code, client=client, user_id=data['user_id'],
+            expires=data['expires'], redirect_uri=data['redirect_uri'],
+            scope=data['scope'])
+
+    def consume(self, grant):
+        # add() only succeeds for the first caller. The marker outlives the
+        # grant so late callers can't win either.
+        if not self.cache.add(_key('consumed', grant.code), True,
+                int(constants.EXPIRE_CODE_DELTA.total_seconds())):
+            return False
+        self.cache.delete(_key('grant', grant.code))
+        return True
+
+
+_stores = {}
+
+
+def get_grant_store():
+    """
+    Return the instance of the store configured in
+    :attr:`provider.constants.GRANT_STORE`.
+    """
+    path = constants.GRANT_STORE
+    try:
+        return _stores[path]
+    except KeyError:
+        _stores[path] = import_string(path)()
+        return _stores[path]
@@ -1,20 +1,44 @@
 import json
+import os
+import socket
 import urlparse
 import datetime
-from django.http import QueryDict
+import time
+from django.http import QueryDict, HttpResponse
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.html import escape
-from django.test import TestCase
+from django.utils.six import StringIO
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.db import connection, IntegrityError, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.views.generic import View
 from django.contrib.auth.models import User
 from .. import constants, scope
 from ..compat import skipIfCustomUser
 from ..templatetags.scope import scopes
-from ..utils import now as date_now
-from .forms import ClientForm
+from ..utils import now as date_now, signed_token, read_signed_token
+from ..utils import token_digest
+from .forms import ClientForm, RefreshTokenGrantForm
+from .forms import ClientAuthForm, PublicClientAuthForm
+from .forms import AuthorizationCodeGrantForm, PasswordGrantForm
 from .models import Client, Grant, AccessToken, RefreshToken
+from .models import ArchivedAccessToken, ArchivedRefreshToken, ArchivedGrant
 from .backends import BasicClientBackend, RequestParamsClientBackend
-from .backends import AccessTokenBackend
+from .backends import AccessTokenBackend, ClientBackend
+from .cache import LRUCache, TokenCache, BloomFilter, LiveTokenFilter
+from .cache import ClientCache, RevocationList
+from .middleware import AuthenticationMiddleware, get_user, extract_token
+from .decorators import scope_required
+from .mixins import ScopeRequiredMixin
+from .views import AccessTokenView
+from .admin import revoke_client_tokens
+from ..views import OAuthError
+from .stores import CacheGrantStore, DatabaseGrantStore
+from .managers import check_plaintext
+from . import cache, indexes, instrumentation, maintenance, validators
 
 
 @skipIfCustomUser
@@ -480,6 +504,16 @@ class AuthBackendTest(BaseOAuth2TestCase):
 
         self.assertIsNotNone(authenticated)
 
+    def test_access_token_backend_loads_related_objects(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+
+        with self.assertNumQueries(1):
+            authenticated = AccessTokenBackend().authenticate(
+                access_token=token.token, client=token.client)
+            self.assertEqual(token.user_id, authenticated.user.pk)
+            self.assertEqual(token.client_id, authenticated.client.pk)
+
 
 class EnforceSecureTest(BaseOAuth2TestCase):
     fixtures = ['test_oauth2']
@@ -621,3 +655,1494 @@ class DeleteExpiredTest(BaseOAuth2TestCase):
                          .exists())
         self.assertFalse(RefreshToken.objects.filter(token=refresh_token)
                          .exists())
+
+
+def create_user_and_client(username='token-user', **kwargs):
+    user = User.objects.create_user(username, password='test')
+    client = Client.objects.create(user=user, url='http://example.com/',
+        redirect_uri='http://example.com/application/', **kwargs)
+    return user, client
+
+
+class LRUCacheTest(TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        self.cache = LRUCache(2, 60, timer=lambda: self.time)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(1, self.cache.get('a'))
+        self.cache.set('c', 3)
+
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(3, self.cache.get('c'))
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=10)
+        self.time += 11
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.time += 50
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_ttl_cannot_exceed_default(self):
+        self.cache.set('a', 1, ttl=3600)
+        self.time += 61
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_disabled_cache(self):
+        disabled = LRUCache(0, 60)
+        disabled.set('a', 1)
+        self.assertIsNone(disabled.get('a'))
+
+
+class TokenCacheMiddlewareTest(TestCase):
+    def setUp(self):
+        self._tokens = cache.tokens
+        cache.tokens = TokenCache(maxsize=10, ttl=60)
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+
+    def tearDown(self):
+        cache.tokens = self._tokens
+
+    def request(self, token):
+        return RequestFactory().get('/',
+            HTTP_AUTHORIZATION='token %s' % token)
+
+    def test_resolved_token_is_cached(self):
+        with self.assertNumQueries(1):
+            user = get_user(self.request(self.token.token))
+        self.assertEqual(self.user.pk, user.pk)
+
+        with self.assertNumQueries(0):
+            user = get_user(self.request(self.token.token))
+        self.assertEqual(self.user.pk, user.pk)
+
+    def test_cached_user_is_not_shared(self):
+        get_user(self.request(self.token.token))
+        user = get_user(self.request(self.token.token))
+        user.first_name = 'changed'
+        self.assertEqual('', get_user(self.request(self.token.token)).first_name)
+
+    def test_cache_is_capped_by_token_expiry(self):
+        self.token.expires = date_now() + datetime.timedelta(seconds=1)
+        self.token.save()
+        get_user(self.request(self.token.token))
+        cache.tokens.local.timer = lambda: time.time() + 2
+        with self.assertNumQueries(1):
+            get_user(self.request(self.token.token))
+
+    def test_invalidation_evicts_cached_token(self):
+        get_user(self.request(self.token.token))
+        AccessTokenView().invalidate_access_token(self.token)
+
+        user = get_user(self.request(self.token.token))
+        self.assertFalse(user.is_authenticated())
+
+
+class BloomFilterTest(TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        tokens = [AccessToken._meta.get_field('token').default()
+                  for i in range(1000)]
+        for token in tokens:
+            bloom.add(token)
+        for token in tokens:
+            self.assertTrue(bloom.might_contain(token))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('live-%d' % i)
+        false_positives = sum(1 for i in range(10000)
+                              if bloom.might_contain('unknown-%d' % i))
+        self.assertTrue(false_positives < 300, false_positives)
+
+
+class LiveTokenFilterTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+        self.time = 1000.0
+        self.filter = LiveTokenFilter(capacity=100, error_rate=0.001,
+            rebuild_interval=3600, sync_interval=0, sync_window=60,
+            timer=lambda: self.time, spawn=lambda target: target())
+
+    def test_rejects_unknown_tokens(self):
+        self.assertTrue(self.filter.might_contain(self.token.token))
+        self.assertFalse(self.filter.might_contain('unknown'))
+
+    def test_known_tokens_do_not_query(self):
+        self.filter.rebuild()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.filter.might_contain(self.token.token))
+
+    def test_syncs_tokens_issued_elsewhere(self):
+        self.filter.rebuild()
+        # Created without passing through this filter, as on another node
+        token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+        self.time += 1
+        spawned = []
+        self.filter.spawn = spawned.append
+        with self.assertNumQueries(0):
+            self.assertTrue(self.filter.might_contain(token.token))
+        self.assertEqual(1, len(spawned))
+        with self.assertNumQueries(1):
+            spawned[0]()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.filter.might_contain(token.token))
+
+    def test_misses_are_looked_up_until_synced(self):
+        self.filter.rebuild()
+        self.filter.sync_interval = 10
+        spawned = []
+        self.filter.spawn = spawned.append
+        self.time += 1
+        self.assertTrue(self.filter.might_contain('unknown'))
+        self.assertTrue(self.filter.might_contain('unknown'))
+        self.assertEqual(1, len(spawned))
+        spawned[0]()
+        # The sync started after the request was received
+        self.assertFalse(self.filter.might_contain('unknown'))
+
+        # At most one sync per interval
+        self.time += 1
+        self.assertTrue(self.filter.might_contain('unknown'))
+        self.assertEqual(1, len(spawned))
+        self.time += 10
+        self.assertTrue(self.filter.might_contain('unknown'))
+        self.assertEqual(2, len(spawned))
+
+    def test_syncs_tokens_committed_out_of_order(self):
+        self.filter.rebuild()
+        later = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client, pk=self.token.pk + 10)
+        self.time += 1
+        self.filter.might_contain('unknown')
+        self.assertEqual(later.pk, self.filter.watermark)
+
+        # Got its key before the token above but committed after the sync
+        earlier = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client, pk=self.token.pk + 5)
+        self.time += 1
+        self.filter.might_contain(earlier.token)
+        self.assertTrue(self.filter.filter.might_contain(
+            token_digest(earlier.token)))
+
+    def test_sync_window_moves_on(self):
+        self.filter.rebuild()
+        token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+        self.time += 1
+        self.filter.might_contain('unknown')
+        for step in range(3):
+            self.time += 61
+            self.filter.might_contain('unknown')
+        # Only keys past the token above are scanned by now
+        self.assertEqual(token.pk, self.filter.watermarks[0][1])
+
+    def test_rebuild_is_spawned(self):
+        spawned = []
+        self.filter.spawn = spawned.append
+        with self.assertNumQueries(0):
+            self.assertTrue(self.filter.might_contain('unknown'))
+            self.assertTrue(self.filter.might_contain('unknown'))
+        self.assertEqual(1, len(spawned))
+        spawned[0]()
+        self.assertFalse(self.filter.might_contain('unknown'))
+
+    def test_expired_tokens_leave_on_rebuild(self):
+        self.token.expires = date_now() - datetime.timedelta(days=1)
+        self.token.save()
+        self.filter.rebuild()
+        self.assertFalse(self.filter.might_contain(self.token.token))
+
+    def test_disabled_filter(self):
+        disabled = LiveTokenFilter(capacity=0)
+        with self.assertNumQueries(0):
+            self.assertTrue(disabled.might_contain('unknown'))
+
+
+class NegativeCacheTest(TestCase):
+    def setUp(self):
+        self._rejected = cache.rejected
+        cache.rejected = LRUCache(10, 60)
+        self.user, self.oauth_client = create_user_and_client()
+
+    def tearDown(self):
+        cache.rejected = self._rejected
+
+    def test_unknown_access_token_is_remembered(self):
+        request = lambda: RequestFactory().get('/',
+            HTTP_AUTHORIZATION='token unknown')
+        with self.assertNumQueries(1):
+            self.assertFalse(get_user(request()).is_authenticated())
+        with self.assertNumQueries(0):
+            self.assertFalse(get_user(request()).is_authenticated())
+
+    def test_unknown_refresh_token_is_remembered(self):
+        data = {'refresh_token': 'unknown'}
+        with self.assertNumQueries(1):
+            form = RefreshTokenGrantForm(data, client=self.oauth_client)
+            self.assertFalse(form.is_valid())
+        with self.assertNumQueries(0):
+            form = RefreshTokenGrantForm(data, client=self.oauth_client)
+            self.assertFalse(form.is_valid())
+        self.assertEqual('invalid_grant', form.errors['error'])
+
+    def test_issued_token_is_forgotten(self):
+        cache.rejected.set(('access', 'issued'), True)
+        AccessToken.objects.create(user=self.user, client=self.oauth_client,
+            token='issued')
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='token issued')
+        self.assertEqual(self.user.pk, get_user(request).pk)
+
+
+class SharedTokenCacheTest(TestCase):
+    def setUp(self):
+        self._tokens = cache.tokens
+        # Two nodes sharing the default locmem cache, without local tiers
+        self.node = cache.tokens = TokenCache(maxsize=0, backend='default')
+        self.other_node = TokenCache(maxsize=0, backend='default')
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+
+    def tearDown(self):
+        self.node.delete(self.token.token)
+        cache.tokens = self._tokens
+
+    def test_token_is_shared_between_nodes(self):
+        AccessToken.objects.get_token(self.token.token)
+        with self.assertNumQueries(0):
+            token = self.other_node.get(self.token.token)
+        self.assertEqual(self.token.pk, token.pk)
+        self.assertEqual(self.user.pk, token.user.pk)
+
+    def test_saving_token_invalidates_all_nodes(self):
+        self.node.set(AccessToken.objects.resolve(self.token.token))
+        self.token.expires = date_now() - datetime.timedelta(days=1)
+        self.token.save()
+        self.assertIsNone(self.other_node.get(self.token.token))
+
+    def test_deleting_token_invalidates_all_nodes(self):
+        self.node.set(AccessToken.objects.resolve(self.token.token))
+        self.token.delete()
+        self.assertIsNone(self.other_node.get(self.token.token))
+
+    def test_invalidating_refresh_token_invalidates_all_nodes(self):
+        refresh_token = RefreshToken.objects.create(user=self.user,
+            access_token=self.token, client=self.oauth_client)
+        self.node.set(AccessToken.objects.resolve(self.token.token))
+        AccessTokenView().invalidate_refresh_token(refresh_token)
+        self.assertIsNone(self.other_node.get(self.token.token))
+
+    def test_no_local_copies_with_a_shared_backend(self):
+        node = TokenCache(maxsize=10, backend='default')
+        other_node = TokenCache(maxsize=10, backend='default')
+        node.set(AccessToken.objects.resolve(self.token.token))
+        self.assertIsNotNone(other_node.get(self.token.token))
+        # Revoked on the first node
+        node.delete(self.token.token)
+        self.assertIsNone(other_node.get(self.token.token))
+        self.assertEqual(0, len(other_node.local))
+
+
+class ClientCacheTest(TestCase):
+    def setUp(self):
+        self._clients = cache.clients
+        self.node = cache.clients = ClientCache(maxsize=10, ttl=60,
+            backend='default')
+        self.other_node = ClientCache(maxsize=10, ttl=60, backend='default')
+        self.user, self.oauth_client = create_user_and_client()
+
+    def tearDown(self):
+        self.node.delete(self.oauth_client.client_id)
+        cache.clients = self._clients
+
+    def authenticate(self, **data):
+        data.setdefault('client_id', self.oauth_client.client_id)
+        data.setdefault('client_secret', self.oauth_client.client_secret)
+        form = ClientAuthForm(data)
+        return form.cleaned_data['client'] if form.is_valid() else None
+
+    def test_authentication_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.oauth_client.pk, self.authenticate().pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.oauth_client.pk, self.authenticate().pk)
+            self.assertIsNone(self.authenticate(client_secret='wrong'))
+        with self.assertNumQueries(0):
+            client = self.other_node.get(self.oauth_client.client_id)
+        self.assertEqual(self.oauth_client.pk, client.pk)
+
+    def test_public_client(self):
+        self.oauth_client.client_type = 1
+        self.oauth_client.save()
+        data = {'client_id': self.oauth_client.client_id,
+            'grant_type': 'password'}
+        self.assertTrue(PublicClientAuthForm(data).is_valid())
+        with self.assertNumQueries(0):
+            self.assertTrue(PublicClientAuthForm(data).is_valid())
+
+    def test_saving_client_invalidates_all_nodes(self):
+        self.authenticate()
+        self.assertIsNotNone(self.other_node.get(self.oauth_client.client_id))
+        self.oauth_client.client_secret = 'rotated'
+        self.oauth_client.save()
+        self.assertIsNone(self.other_node.get(self.oauth_client.client_id))
+        self.assertIsNone(self.authenticate(client_secret='wrong'))
+        self.assertIsNotNone(self.authenticate(client_secret='rotated'))
+
+    def test_deleting_client_invalidates_all_nodes(self):
+        self.authenticate()
+        self.assertIsNotNone(self.other_node.get(self.oauth_client.client_id))
+        self.oauth_client.delete()
+        self.assertIsNone(self.other_node.get(self.oauth_client.client_id))
+        self.assertIsNone(self.authenticate())
+
+    def test_entries_are_versioned(self):
+        self.authenticate()
+        self.other_node._schema = 'other'
+        self.assertIsNone(self.other_node.get(self.oauth_client.client_id))
+
+    def test_changes_while_reading_are_not_cached(self):
+        client_id = self.oauth_client.client_id
+        version = self.node.version(client_id)
+        stale = Client.objects.get(pk=self.oauth_client.pk)
+        self.oauth_client.client_secret = 'rotated'
+        self.oauth_client.save()
+        self.node.set(stale, version)
+        self.assertIsNone(self.node.get(client_id))
+        self.assertIsNone(self.other_node.get(client_id))
+        self.assertEqual('rotated', self.authenticate(
+            client_secret='rotated').client_secret)
+
+
+class ClientBackendTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+
+    def test_client_backend(self):
+        client = self.oauth_client
+        factory = RequestFactory()
+        basic = "Basic " + "{0}:{1}".format(client.client_id,
+            client.client_secret).encode('base64')
+
+        for request in (
+                factory.post('/', HTTP_AUTHORIZATION=basic),
+                factory.post('/', {'client_id': client.client_id,
+                    'client_secret': client.client_secret}),
+                factory.post('/?client_id=%s' % client.client_id,
+                    {'client_secret': client.client_secret})):
+            with self.assertNumQueries(1):
+                self.assertEqual(client.pk,
+                    ClientBackend().authenticate(request).pk)
+
+        for request in (
+                factory.post('/', HTTP_AUTHORIZATION="Basic !"),
+                factory.post('/', HTTP_AUTHORIZATION="Basic " + "{0}:x"
+                    .format(client.client_id).encode('base64')),
+                factory.post('/', {'client_id': client.client_id,
+                    'client_secret': 'x'}),
+                # Confidential clients can't leave out the secret
+                factory.post('/', {'client_id': client.client_id,
+                    'grant_type': 'password'})):
+            self.assertIsNone(ClientBackend().authenticate(request))
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(ClientBackend().authenticate(factory.post('/')))
+
+    def test_client_backend_public_client(self):
+        client = self.oauth_client
+        client.client_type = constants.PUBLIC
+        client.save()
+        factory = RequestFactory()
+
+        request = factory.post('/', {'client_id': client.client_id,
+            'grant_type': 'password'})
+        with self.assertNumQueries(1):
+            self.assertEqual(client.pk,
+                ClientBackend().authenticate(request).pk)
+        request = factory.post('/', {'client_id': client.client_id,
+            'grant_type': 'client_credentials'})
+        self.assertIsNone(ClientBackend().authenticate(request))
+
+        # Credentials that are sent are checked, even for public clients
+        for request in (
+                factory.post('/', {'client_id': client.client_id,
+                    'client_secret': 'x', 'grant_type': 'password'}),
+                factory.post('/', {'client_id': client.client_id,
+                    'grant_type': 'password'}, HTTP_AUTHORIZATION="Basic !")):
+            self.assertIsNone(ClientBackend().authenticate(request))
+
+
+class SignedTokenTest(TestCase):
+    def setUp(self):
+        self._signed_tokens = constants.SIGNED_TOKENS
+        self._revoked = cache.revoked
+        constants.SIGNED_TOKENS = True
+        cache.revoked = RevocationList()
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessTokenView().create_access_token(None, self.user,
+            constants.READ, self.oauth_client)
+
+    def tearDown(self):
+        constants.SIGNED_TOKENS = self._signed_tokens
+        cache.revoked = self._revoked
+
+    def request(self, token):
+        return RequestFactory().get('/',
+            HTTP_AUTHORIZATION='token %s' % token)
+
+    def test_payload(self):
+        payload = read_signed_token(self.token.token)
+        self.assertEqual(self.user.pk, payload['user_id'])
+        self.assertEqual(self.oauth_client.pk, payload['client_id'])
+        self.assertEqual(constants.READ, payload['scope'])
+        self.assertEqual(self.token.expires, payload['expires'])
+
+    def test_revocations_must_be_shared(self):
+        backend = constants.TOKEN_CACHE_BACKEND
+        caches = {'default': {'BACKEND':
+            'django.core.cache.backends.locmem.LocMemCache'}, 'shared': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}}
+        try:
+            with self.settings(CACHES=caches):
+                for alias in (None, 'default'):
+                    constants.TOKEN_CACHE_BACKEND = alias
+                    self.assertRaises(ImproperlyConfigured,
+                        cache.check_revocations)
+                constants.TOKEN_CACHE_BACKEND = 'shared'
+                cache.check_revocations()
+        finally:
+            constants.TOKEN_CACHE_BACKEND = backend
+
+    def test_opaque_and_tampered_tokens_are_not_read(self):
+        self.assertIsNone(read_signed_token('f' * 40))
+        self.assertIsNone(read_signed_token(self.token.token[:-1] + 'x'))
+
+    def test_token_is_verified_without_lookup(self):
+        # Only the user is loaded
+        with self.assertNumQueries(1):
+            user = get_user(self.request(self.token.token))
+        self.assertEqual(self.user.pk, user.pk)
+
+    def test_tampered_token_is_rejected(self):
+        user = get_user(self.request(self.token.token[:-1] + 'x'))
+        self.assertFalse(user.is_authenticated())
+
+    def test_expired_token_is_rejected(self):
+        expired = signed_token(self.user.pk, self.oauth_client.pk,
+            constants.READ, date_now() - datetime.timedelta(seconds=1))
+        with self.assertNumQueries(0):
+            user = get_user(self.request(expired))
+        self.assertFalse(user.is_authenticated())
+
+    def test_invalidated_token_is_revoked(self):
+        AccessTokenView().invalidate_access_token(self.token)
+        with self.assertNumQueries(0):
+            user = get_user(self.request(self.token.token))
+        self.assertFalse(user.is_authenticated())
+
+
+class TokenDigestTest(TestCase):
+    def setUp(self):
+        self._token_digests = constants.TOKEN_DIGESTS
+        constants.TOKEN_DIGESTS = True
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+        self.refresh_token = RefreshToken.objects.create(user=self.user,
+            access_token=self.token, client=self.oauth_client)
+
+    def tearDown(self):
+        constants.TOKEN_DIGESTS = self._token_digests
+        constants.TOKEN_PLAINTEXT = True
+
+    def indexed(self, index):
+        table, name, columns, partial = index
+        return bool(indexes.index_names(connection, table, columns))
+
+    def test_digest_is_saved(self):
+        token = AccessToken.objects.get(pk=self.token.pk)
+        self.assertEqual(token_digest(self.token.token),
+            bytes(token.token_digest))
+
+    def test_lookup_by_digest(self):
+        token = AccessToken.objects.resolve(self.token.token)
+        self.assertEqual(self.token.pk, token.pk)
+
+        form = RefreshTokenGrantForm({'refresh_token': self.refresh_token.token},
+            client=self.oauth_client)
+        self.assertTrue(form.is_valid(), form.errors)
+
+    def test_lookup_ignores_token_column(self):
+        AccessToken.objects.filter(pk=self.token.pk).update(token_digest=None)
+        self.assertRaises(AccessToken.DoesNotExist,
+            AccessToken.objects.resolve, self.token.token)
+
+    def test_backfill(self):
+        AccessToken.objects.filter(pk=self.token.pk).update(token_digest=None)
+        call_command('oauth2_backfill_digests', stdout=open(os.devnull, 'w'))
+        token = AccessToken.objects.resolve(self.token.token)
+        self.assertEqual(self.token.pk, token.pk)
+        for index in indexes.DIGEST:
+            self.assertTrue(self.indexed(index), index)
+
+    def test_saved_without_plaintext(self):
+        constants.TOKEN_PLAINTEXT = False
+        tokens = cache.tokens
+        cache.tokens = TokenCache(maxsize=10, ttl=60)
+        try:
+            token = AccessToken.objects.create(user=self.user,
+                client=self.oauth_client)
+            self.assertTrue(token.token)
+            self.assertEqual('', AccessToken.objects.filter(
+                pk=token.pk).values_list('token', flat=True)[0])
+
+            resolved = AccessToken.objects.get_token(token.token)
+            self.assertEqual(token.token, resolved.token)
+            # Evicted by digest
+            AccessToken.all_objects.filter(pk=token.pk).revoke()
+            self.assertIsNone(cache.tokens.get(token.token))
+        finally:
+            cache.tokens = tokens
+
+    def test_clear_plaintext(self):
+        self.assertRaises(CommandError, call_command,
+            'oauth2_clear_plaintext', stdout=open(os.devnull, 'w'))
+        constants.TOKEN_PLAINTEXT = False
+        call_command('oauth2_backfill_digests', stdout=open(os.devnull, 'w'))
+        call_command('oauth2_clear_plaintext', stdout=open(os.devnull, 'w'))
+
+        self.assertFalse(AccessToken.objects.exclude(token='').exists())
+        self.assertFalse(RefreshToken.objects.exclude(token='').exists())
+        for index in indexes.PLAINTEXT:
+            self.assertFalse(self.indexed(index), index)
+
+        self.assertEqual(self.token.pk,
+            AccessToken.objects.resolve(self.token.token).pk)
+        refresh_token = validators.clean_refresh_token(
+            self.refresh_token.token, self.oauth_client)
+        self.assertEqual(self.refresh_token.token, refresh_token.token)
+
+    def test_clear_plaintext_needs_digests(self):
+        constants.TOKEN_PLAINTEXT = False
+        AccessToken.objects.filter(pk=self.token.pk).update(token_digest=None)
+        self.assertRaises(CommandError, call_command,
+            'oauth2_clear_plaintext', stdout=open(os.devnull, 'w'))
+        self.assertTrue(AccessToken.objects.exclude(token='').exists())
+
+    def test_check_plaintext(self):
+        check_plaintext()
+        constants.TOKEN_PLAINTEXT = False
+        check_plaintext()
+        for setting in ('TOKEN_DIGESTS', 'SIGNED_TOKENS',
+                'SINGLE_ACCESS_TOKEN'):
+            value = getattr(constants, setting)
+            setattr(constants, setting, setting != 'TOKEN_DIGESTS')
+            try:
+                self.assertRaises(ImproperlyConfigured, check_plaintext)
+            finally:
+                setattr(constants, setting, value)
+
+
+class TokenExtractionTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_header(self):
+        for scheme in ('token', 'Bearer', 'bearer'):
+            request = self.factory.get('/',
+                HTTP_AUTHORIZATION='%s abc' % scheme)
+            self.assertEqual(('header', 'abc'), extract_token(request))
+
+    def test_malformed_header_stops_extraction(self):
+        request = self.factory.get('/?access_token=abc',
+            HTTP_AUTHORIZATION='Bearer')
+        self.assertEqual(('header', None), extract_token(request))
+
+    def test_other_schemes_are_ignored(self):
+        request = self.factory.get('/?access_token=abc',
+            HTTP_AUTHORIZATION='Basic Zm9vOmJhcg==')
+        self.assertEqual(('query', 'abc'), extract_token(request))
+
+    def test_cookie_before_body(self):
+        request = self.factory.post('/', 'access_token=abc',
+            content_type='application/x-www-form-urlencoded')
+        request.COOKIES['at'] = 'def'
+        self.assertEqual(('cookie', 'def'), extract_token(request))
+
+    def test_form_encoded_body(self):
+        request = self.factory.post('/', 'access_token=abc',
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual(('body', 'abc'), extract_token(request))
+
+    def test_multipart_body_is_not_parsed(self):
+        request = self.factory.post('/', {'access_token': 'abc'})
+        self.assertEqual((None, None), extract_token(request))
+        self.assertFalse(hasattr(request, '_post'))
+
+    def test_large_body_is_not_parsed(self):
+        request = self.factory.post('/', 'access_token=abc&data=' +
+            'x' * constants.BODY_TOKEN_MAX_SIZE,
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual((None, None), extract_token(request))
+        self.assertFalse(hasattr(request, '_post'))
+
+    def test_configured_extractors(self):
+        extractors = constants.TOKEN_EXTRACTORS
+        constants.TOKEN_EXTRACTORS = ('provider.oauth2.extractors.cookie',)
+        try:
+            request = self.factory.get('/?access_token=abc')
+            self.assertEqual((None, None), extract_token(request))
+        finally:
+            constants.TOKEN_EXTRACTORS = extractors
+
+
+class ScopeRequiredTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client, scope=constants.READ)
+
+    def request(self, token=None):
+        if token is None:
+            request = RequestFactory().get('/')
+        else:
+            request = RequestFactory().get('/',
+                HTTP_AUTHORIZATION='Bearer %s' % token)
+        AuthenticationMiddleware().process_request(request)
+        return request
+
+    def test_token_is_loaded_with_user(self):
+        request = self.request(self.token.token)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.pk, request.user.pk)
+            self.assertEqual(self.token.pk, request.oauth_token.pk)
+            self.assertEqual(self.oauth_client.pk,
+                request.oauth_token.client.pk)
+
+    def test_missing_token(self):
+        request = self.request()
+        self.assertFalse(request.oauth_token)
+        self.assertFalse(self.request('invalid').oauth_token)
+
+    def test_decorator(self):
+        read = scope_required('read')(lambda request: HttpResponse('ok'))
+        write = scope_required('write')(lambda request: HttpResponse('ok'))
+
+        request = self.request(self.token.token)
+        request.oauth_token.pk
+        with self.assertNumQueries(0):
+            self.assertEqual(200, read(request).status_code)
+            response = write(request)
+        self.assertEqual(403, response.status_code)
+        self.assertEqual('insufficient_scope',
+            json.loads(response.content)['error'])
+
+        self.assertEqual(401, read(self.request()).status_code)
+
+    def test_mixin(self):
+        class ReadView(ScopeRequiredMixin, View):
+            required_scopes = ('read',)
+
+            def get(self, request):
+                return HttpResponse('ok')
+
+        class WriteView(ReadView):
+            required_scopes = ('write',)
+
+        request = self.request(self.token.token)
+        self.assertEqual(200, ReadView.as_view()(request).status_code)
+        self.assertEqual(403, WriteView.as_view()(request).status_code)
+        self.assertEqual(401, ReadView.as_view()(self.request()).status_code)
+
+    def test_unknown_scope(self):
+        self.assertRaises(ImproperlyConfigured, scope_required, 'unknown')
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self._sinks = constants.INSTRUMENTATION_SINKS
+        constants.INSTRUMENTATION_SINKS = (
+            'provider.oauth2.instrumentation.SignalSink',)
+        self.records = []
+        instrumentation.token_resolved.connect(self.receive)
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+
+    def tearDown(self):
+        constants.INSTRUMENTATION_SINKS = self._sinks
+        instrumentation.token_resolved.disconnect(self.receive)
+
+    def receive(self, sender, source, outcome, duration, **kwargs):
+        self.records.append((source, outcome))
+        self.assertTrue(duration >= 0)
+
+    def test_outcomes(self):
+        get_user(RequestFactory().get('/'))
+        get_user(RequestFactory().get('/?access_token=%s' % self.token.token))
+        get_user(RequestFactory().get('/', HTTP_AUTHORIZATION='Bearer abc'))
+        self.assertEqual([
+            (None, instrumentation.NO_TOKEN),
+            ('query', instrumentation.LOADED),
+            ('header', instrumentation.NOT_FOUND),
+        ], self.records)
+
+    def test_cache_hit(self):
+        tokens = cache.tokens
+        cache.tokens = TokenCache(maxsize=10, ttl=60)
+        try:
+            for i in range(2):
+                get_user(RequestFactory().get('/',
+                    HTTP_AUTHORIZATION='Bearer %s' % self.token.token))
+        finally:
+            cache.tokens = tokens
+        self.assertEqual([
+            ('header', instrumentation.LOADED),
+            ('header', instrumentation.CACHED),
+        ], self.records)
+
+    def test_disabled(self):
+        constants.INSTRUMENTATION_SINKS = ()
+        get_user(RequestFactory().get('/'))
+        self.assertEqual([], self.records)
+
+    def test_statsd(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        try:
+            sink = instrumentation.StatsdSink('127.0.0.1',
+                listener.getsockname()[1], 'test')
+            sink.record('cookie', instrumentation.CACHED, 0.001)
+            lines = listener.recv(1024).decode('ascii').split('\n')
+        finally:
+            listener.close()
+        self.assertEqual(['test.source.cookie:1|c', 'test.outcome.cached:1|c',
+            'test.resolve:1.000|ms'], lines)
+
+
+class IndexTest(TestCase):
+    def index_columns(self, model):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor,
+                model._meta.db_table)
+        return [tuple(c['columns']) for c in constraints.values()
+            if c['index'] or c['unique']]
+
+    def test_hot_lookups_are_indexed(self):
+        self.assertIn(('token', 'expires', 'user_id'),
+            self.index_columns(AccessToken))
+        self.assertIn(('user_id', 'client_id', 'scope', 'expires'),
+            self.index_columns(AccessToken))
+        self.assertIn(('code', 'client_id', 'expires'),
+            self.index_columns(Grant))
+        self.assertIn(('token', 'client_id', 'expired'),
+            self.index_columns(RefreshToken))
+
+    def test_live_tokens_are_indexed(self):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            return
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor,
+                AccessToken._meta.db_table)
+        self.assertIn('oauth2_accesstoken_live_token', constraints)
+
+    def test_one_index_per_token_lookup(self):
+        columns = self.index_columns(AccessToken)
+        self.assertEqual(1, columns.count(('token', 'expires', 'user_id')))
+        # Digests are off, oauth2_backfill_digests creates their indexes
+        self.assertNotIn(('token_digest', 'expires', 'user_id'), columns)
+
+    def test_client_id_is_unique(self):
+        user, client = create_user_and_client()
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, Client.objects.create,
+                user=user, client_id=client.client_id,
+                url='http://example.com/',
+                redirect_uri='http://example.com/application/')
+
+
+class PurgeExpiredTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+        past = date_now() - datetime.timedelta(days=1)
+        self.live = self.create_token()
+        self.refreshable = self.create_token(expires=past)
+        self.refreshed = self.create_token(expires=past, expired=True)
+        self.unrefreshable = self.create_token(expires=past, refresh=False)
+        self.grant = Grant.objects.create(user=self.user,
+            client=self.oauth_client)
+        self.expired_grant = Grant.objects.create(user=self.user,
+            client=self.oauth_client, expires=past)
+
+    def create_token(self, refresh=True, expired=False, **kwargs):
+        token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client, **kwargs)
+        if refresh:
+            RefreshToken.objects.create(user=self.user, access_token=token,
+                client=self.oauth_client, expired=expired)
+        return token
+
+    def test_purge(self):
+        out = StringIO()
+        call_command('oauth2_purge_expired', batch_size=1, stdout=out)
+
+        self.assertEqual(set([self.live.pk, self.refreshable.pk]),
+            set(AccessToken.objects.values_list('pk', flat=True)))
+        self.assertEqual(set([self.live.pk, self.refreshable.pk]),
+            set(RefreshToken.objects.values_list('access_token', flat=True)))
+        self.assertEqual([self.grant.pk],
+            list(Grant.objects.values_list('pk', flat=True)))
+        self.assertIn('access tokens: 1 deleted', out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+
+    def test_archive(self):
+        call_command('oauth2_purge_expired', archive=True, batch_size=1,
+            stdout=StringIO())
+
+        self.assertEqual(set([self.live.pk, self.refreshable.pk]),
+            set(AccessToken.objects.values_list('pk', flat=True)))
+        self.assertEqual(set([self.refreshed.pk, self.unrefreshable.pk]),
+            set(ArchivedAccessToken.objects.values_list('pk', flat=True)))
+        archived = ArchivedRefreshToken.objects.get()
+        self.assertEqual(self.refreshed.pk, archived.access_token_id)
+        self.assertEqual(self.refreshed.token, archived.access_token.token)
+        archived = ArchivedGrant.objects.get()
+        self.assertEqual((self.expired_grant.pk, self.expired_grant.code),
+            (archived.pk, archived.code))
+        self.assertEqual([self.grant.pk],
+            list(Grant.objects.values_list('pk', flat=True)))
+
+    def test_archive_keeps_refresh_tokens(self):
+        self.refreshable.refresh_token.expired = True
+        self.refreshable.refresh_token.save()
+        queryset = maintenance.expired_access_tokens()
+        list(maintenance.archive(queryset.filter(pk=self.refreshable.pk)))
+        self.assertEqual(self.refreshable.refresh_token.pk,
+            ArchivedRefreshToken.objects.get().pk)
+
+    def test_batches(self):
+        queryset = AccessToken.objects.all()
+        pks = [pk for batch in maintenance.batches(queryset, 3)
+            for pk in batch]
+        self.assertEqual(list(queryset.order_by('pk').values_list('pk',
+            flat=True)), pks)
+
+
+class SoftDeleteTest(TestCase):
+    def setUp(self):
+        self._tokens = cache.tokens
+        cache.tokens = TokenCache(maxsize=10, ttl=60)
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+
+    def tearDown(self):
+        cache.tokens = self._tokens
+
+    def test_revoke(self):
+        get_user(RequestFactory().get('/',
+            HTTP_AUTHORIZATION='Bearer %s' % self.token.token))
+
+        # The lookup, then both UPDATEs in a savepoint
+        with self.assertNumQueries(5):
+            self.assertEqual(1, AccessToken.objects.filter(
+                user=self.user).revoke())
+
+        self.assertFalse(AccessToken.objects.filter(pk=self.token.pk).exists())
+        self.assertTrue(AccessToken.all_objects.get(pk=self.token.pk).is_deleted)
+        user = get_user(RequestFactory().get('/',
+            HTTP_AUTHORIZATION='Bearer %s' % self.token.token))
+        self.assertFalse(user.is_authenticated())
+
+    def test_invalidate_access_token(self):
+        AccessTokenView().invalidate_access_token(self.token)
+        self.assertRaises(AccessToken.DoesNotExist,
+            AccessToken.objects.resolve, self.token.token)
+        self.assertEqual(self.token.expires,
+            AccessToken.all_objects.get(pk=self.token.pk).expires)
+
+    def test_admin_shows_revoked_tokens(self):
+        from .admin import AccessTokenAdmin
+        from django.contrib.admin import site
+
+        AccessToken.objects.filter(pk=self.token.pk).revoke()
+        modeladmin = AccessTokenAdmin(AccessToken, site)
+        queryset = modeladmin.get_queryset(RequestFactory().get('/'))
+        self.assertEqual([self.token.pk], [access_token.pk
+            for access_token in queryset])
+        self.assertEqual(0, queryset.revoke())
+
+    def test_revoked_tokens_are_purged(self):
+        AccessToken.objects.filter(pk=self.token.pk).revoke()
+        call_command('oauth2_purge_expired', verbosity=0)
+        self.assertFalse(AccessToken.all_objects.exists())
+
+
+class GrantStoreTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+        self.other_user, self.other_client = create_user_and_client('other')
+
+    def grant(self):
+        return Grant(user=self.user, client=self.oauth_client,
+            redirect_uri='http://example.com/application/',
+            scope=constants.READ)
+
+    def test_database_store(self):
+        store = DatabaseGrantStore()
+        grant = self.grant()
+        store.save(grant)
+
+        self.assertEqual(grant.pk, store.get(self.oauth_client, grant.code).pk)
+        self.assertIsNone(store.get(self.other_client, grant.code))
+        self.assertTrue(store.consume(grant))
+        self.assertIsNone(store.get(self.oauth_client, grant.code))
+
+    def test_cache_store(self):
+        store = CacheGrantStore('default')
+        grant = self.grant()
+        with self.assertNumQueries(0):
+            store.save(grant)
+            stored = store.get(self.oauth_client, grant.code)
+        self.assertFalse(Grant.objects.exists())
+
+        self.assertEqual((self.user.pk, constants.READ, grant.redirect_uri),
+            (stored.user.pk, stored.scope, stored.redirect_uri))
+        self.assertIsNone(store.get(self.other_client, grant.code))
+
+        self.assertTrue(store.consume(stored))
+        self.assertFalse(store.consume(stored))
+        self.assertIsNone(store.get(self.oauth_client, grant.code))
+
+    def test_consume(self):
+        grant = self.grant()
+        grant.save()
+        with self.assertNumQueries(1):
+            self.assertTrue(Grant.objects.consume(self.oauth_client,
+                grant.code))
+        self.assertFalse(Grant.objects.consume(self.oauth_client, grant.code))
+
+        delete_expired = constants.DELETE_EXPIRED
+        constants.DELETE_EXPIRED = True
+        try:
+            grant = self.grant()
+            grant.save()
+            self.assertFalse(Grant.objects.consume(self.other_client,
+                grant.code))
+            self.assertTrue(Grant.objects.consume(self.oauth_client,
+                grant.code))
+            self.assertFalse(Grant.objects.filter(pk=grant.pk).exists())
+        finally:
+            constants.DELETE_EXPIRED = delete_expired
+
+    def test_code_is_exchanged_once(self):
+        grant = self.grant()
+        grant.save()
+        request = RequestFactory().post('/', {'code': grant.code})
+
+        # Both requests validated the code before either consumed it
+        class View(AccessTokenView):
+            def get_authorization_code_grant(self, request, data, client):
+                return grant
+
+        response = View().authorization_code(request, request.POST,
+            self.oauth_client)
+        self.assertEqual(200, response.status_code)
+        response = View().authorization_code(request, request.POST,
+            self.oauth_client)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(1, AccessToken.objects.count())
+
+    def test_cache_store_drops_expired_grants(self):
+        store = CacheGrantStore('default')
+        grant = self.grant()
+        grant.expires = date_now() - datetime.timedelta(seconds=1)
+        store.save(grant)
+        self.assertIsNone(store.get(self.oauth_client, grant.code))
+
+
+class RefreshTokenRotationTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client, scope=constants.READ)
+        self.refresh_token = RefreshToken.objects.create(user=self.user,
+            access_token=self.token, client=self.oauth_client)
+
+    def refresh(self):
+        request = RequestFactory().post('/', {
+            'grant_type': 'refresh_token',
+            'refresh_token': self.refresh_token.token,
+        })
+        return AccessTokenView().refresh_token(request, request.POST,
+            self.oauth_client)
+
+    def test_rotation(self):
+        with self.assertNumQueries(7):
+            response = self.refresh()
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+
+        at = AccessToken.objects.get(token=data['access_token'])
+        self.assertEqual((self.user.pk, constants.READ),
+            (at.user_id, at.scope))
+        self.assertEqual(data['refresh_token'], at.refresh_token.token)
+        self.assertTrue(RefreshToken.objects.get(
+            pk=self.refresh_token.pk).expired)
+        self.assertTrue(AccessToken.all_objects.get(
+            pk=self.token.pk).is_deleted)
+
+    def test_refresh_token_is_used_once(self):
+        rt = RefreshToken.objects.get(pk=self.refresh_token.pk)
+        view = AccessTokenView()
+        view.rotate_refresh_token(None, rt, self.oauth_client)
+        self.assertRaises(OAuthError, view.rotate_refresh_token, None, rt,
+            self.oauth_client)
+        self.assertEqual(1, AccessToken.objects.count())
+
+
+class RefreshTokenGracePeriodTest(TransactionTestCase):
+    # Pairs are published once the exchange commits
+    def setUp(self):
+        self._rotated = cache.rotated
+        self.slept = []
+        cache.rotated = cache.RotatedTokens(ttl=30, backend='default',
+            sleep=self.sleep)
+        self.user, self.oauth_client = create_user_and_client(
+            scope=constants.READ_WRITE)
+        self.token = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client, scope=constants.READ)
+        self.refresh_token = RefreshToken.objects.create(user=self.user,
+            access_token=self.token, client=self.oauth_client)
+
+    def tearDown(self):
+        cache.rotated = self._rotated
+
+    def sleep(self, delay):
+        self.slept.append(delay)
+
+    def refresh(self, **data):
+        data.update(grant_type='refresh_token',
+            refresh_token=self.refresh_token.token)
+        request = RequestFactory().post('/', data)
+        return AccessTokenView().refresh_token(request, request.POST,
+            self.oauth_client)
+
+    def test_grace_period(self):
+        first = json.loads(self.refresh().content)
+        with self.assertNumQueries(0):
+            response = self.refresh()
+        self.assertEqual(first['access_token'],
+            json.loads(response.content)['access_token'])
+        self.assertEqual(first['refresh_token'],
+            json.loads(response.content)['refresh_token'])
+
+        # Requests that were validated before the first one committed
+        rt = RefreshToken.objects.get(pk=self.refresh_token.pk)
+        at = AccessTokenView().rotate_refresh_token(None, rt,
+            self.oauth_client)
+        self.assertEqual(first['access_token'], at.token)
+        self.assertEqual(1, AccessToken.objects.count())
+
+    def test_pair_is_published_on_commit(self):
+        with transaction.atomic():
+            first = json.loads(self.refresh().content)
+            self.assertIsNone(cache.rotated.get(self.oauth_client.pk,
+                self.refresh_token.token))
+        self.assertEqual(first['access_token'], cache.rotated.get(
+            self.oauth_client.pk, self.refresh_token.token).token)
+
+    def test_waits_for_the_pair(self):
+        pending = []
+        publish = cache.rotated.set
+        cache.rotated.set = lambda *args: pending.append(args)
+
+        def sleep(delay):
+            # The first exchange publishes its pair meanwhile
+            while pending:
+                publish(*pending.pop())
+        cache.rotated.sleep = sleep
+
+        first = json.loads(self.refresh().content)
+        self.assertEqual(1, len(pending))
+        second = json.loads(self.refresh().content)
+        self.assertEqual(first['access_token'], second['access_token'])
+
+    def test_unknown_refresh_token_gives_up(self):
+        self.refresh()
+        self.refresh_token.token = 'unknown'
+        with self.assertRaises(OAuthError) as raised:
+            self.refresh()
+        self.assertEqual('invalid_grant', raised.exception.args[0]['error'])
+        self.assertEqual(5, len(self.slept))
+
+    def test_scope_is_checked(self):
+        self.refresh()
+        with self.assertRaises(OAuthError) as raised:
+            self.refresh(scope='write')
+        self.assertEqual('invalid_scope', raised.exception.args[0]['error'])
+        self.refresh(scope='read')
+
+    def test_grace_cache_must_be_shared(self):
+        period = constants.REFRESH_GRACE_PERIOD
+        backend = constants.REFRESH_GRACE_CACHE_BACKEND
+        caches = {'default': {'BACKEND':
+            'django.core.cache.backends.locmem.LocMemCache'}, 'shared': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}}
+        try:
+            with self.settings(CACHES=caches):
+                constants.REFRESH_GRACE_CACHE_BACKEND = 'default'
+                constants.REFRESH_GRACE_PERIOD = 0
+                cache.check_rotations()
+                constants.REFRESH_GRACE_PERIOD = 30
+                self.assertRaises(ImproperlyConfigured,
+                    cache.check_rotations)
+                constants.REFRESH_GRACE_CACHE_BACKEND = 'shared'
+                cache.check_rotations()
+        finally:
+            constants.REFRESH_GRACE_PERIOD = period
+            constants.REFRESH_GRACE_CACHE_BACKEND = backend
+
+
+class BulkIssueTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+        self.public_client = Client.objects.create(user=self.user,
+            url='http://example.com/', client_type=constants.PUBLIC,
+            redirect_uri='http://example.com/application/')
+        self.users = [User.objects.create_user('bulk-%d' % i)
+            for i in range(5)]
+
+    def test_bulk_issue(self):
+        grants = [(user, self.oauth_client, constants.READ)
+            for user in self.users] + [(self.user, self.public_client, 0)]
+
+        # Per batch: a savepoint and its release, two INSERTs and the
+        # primary key lookup
+        with self.assertNumQueries(3 * 5):
+            issued = AccessToken.objects.bulk_issue(grants, batch_size=2)
+            refresh_tokens = [at.refresh_token.token for at in issued]
+
+        self.assertEqual(6, AccessToken.objects.count())
+        self.assertEqual(set(refresh_tokens),
+            set(RefreshToken.objects.values_list('token', flat=True)))
+        for at, (user, client, scope) in zip(issued, grants):
+            stored = AccessToken.objects.resolve(at.token)
+            self.assertEqual((user.pk, client.pk, scope, at.pk),
+                (stored.user_id, stored.client_id, stored.scope, stored.pk))
+            self.assertEqual(token_digest(at.token), stored.token_digest)
+        self.assertEqual(self.public_client.get_default_token_expiry().date(),
+            issued[-1].expires.date())
+        self.assertNotEqual(issued[0].expires.date(), issued[-1].expires.date())
+
+    def test_without_refresh_tokens(self):
+        with self.assertNumQueries(3):
+            AccessToken.objects.bulk_issue([(self.user, self.oauth_client, 0)],
+                refresh=False)
+        self.assertFalse(RefreshToken.objects.exists())
+
+
+class RevokeForTest(TestCase):
+    def setUp(self):
+        self._tokens = cache.tokens
+        cache.tokens = TokenCache(maxsize=10, ttl=60)
+        self.user, self.oauth_client = create_user_and_client()
+        self.other_user, self.other_client = create_user_and_client('other')
+        self.read = self.create_token(self.user, self.oauth_client,
+            constants.READ)
+        self.write = self.create_token(self.user, self.other_client,
+            constants.WRITE)
+        self.other = self.create_token(self.other_user, self.other_client,
+            constants.READ)
+
+    def tearDown(self):
+        cache.tokens = self._tokens
+
+    def create_token(self, user, client, scope):
+        token = AccessToken.objects.create(user=user, client=client,
+            scope=scope)
+        RefreshToken.objects.create(user=user, client=client,
+            access_token=token)
+        return token
+
+    def live(self):
+        return set(AccessToken.objects.values_list('pk', flat=True))
+
+    def refreshable(self):
+        return set(RefreshToken.objects.filter(expired=False).values_list(
+            'access_token', flat=True))
+
+    def test_user(self):
+        cache.tokens.set(AccessToken.objects.resolve(self.read.token))
+        self.assertEqual(2, AccessToken.objects.revoke_for(user=self.user))
+        self.assertEqual(set([self.other.pk]), self.live())
+        self.assertEqual(set([self.other.pk]), self.refreshable())
+        self.assertIsNone(cache.tokens.get(self.read.token))
+
+    def test_client(self):
+        AccessToken.objects.revoke_for(client=self.other_client)
+        self.assertEqual(set([self.read.pk]), self.live())
+        self.assertEqual(set([self.read.pk]), self.refreshable())
+
+    def test_scope(self):
+        AccessToken.objects.revoke_for(scope=constants.WRITE)
+        self.assertEqual(set([self.read.pk, self.other.pk]), self.live())
+        AccessToken.objects.revoke_for(user=self.user, scope=constants.READ)
+        self.assertEqual(set([self.other.pk]), self.live())
+
+    def test_refresh_tokens_of_revoked_access_tokens(self):
+        AccessToken.objects.filter(pk=self.read.pk).update(is_deleted=True)
+        AccessToken.objects.revoke_for(client=self.oauth_client)
+        self.assertNotIn(self.read.pk, self.refreshable())
+
+    def test_requires_criteria(self):
+        self.assertRaises(ValueError, AccessToken.objects.revoke_for)
+
+    def test_admin_action(self):
+        class ModelAdmin(object):
+            def message_user(self, request, message):
+                self.message = message
+
+        modeladmin = ModelAdmin()
+        revoke_client_tokens(modeladmin, None,
+            Client.objects.filter(pk=self.other_client.pk))
+        self.assertEqual(set([self.read.pk]), self.live())
+        self.assertEqual("2 access tokens revoked.", modeladmin.message)
+
+    def test_command(self):
+        call_command('oauth2_revoke_tokens', client=self.other_client.client_id,
+            scope='read', stdout=StringIO())
+        self.assertEqual(set([self.read.pk, self.write.pk]), self.live())
+
+
+class ScopeLookupTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client()
+        self.read, self.write, self.read_write = [
+            AccessToken.objects.create(user=self.user,
+                client=self.oauth_client, scope=value)
+            for value in (constants.READ, constants.WRITE,
+                constants.READ_WRITE)]
+
+    def pks(self, **kwargs):
+        return set(AccessToken.objects.filter(**kwargs).values_list('pk',
+            flat=True))
+
+    def test_has_all(self):
+        self.assertEqual(set([self.read.pk, self.read_write.pk]),
+            self.pks(scope__has_all=constants.READ))
+        self.assertEqual(set([self.read_write.pk]),
+            self.pks(scope__has_all=constants.READ_WRITE))
+
+    def test_has_any(self):
+        self.assertEqual(set([self.read.pk, self.write.pk,
+            self.read_write.pk]), self.pks(scope__has_any=constants.READ_WRITE))
+        self.assertEqual(set([self.write.pk, self.read_write.pk]),
+            self.pks(scope__has_any=constants.WRITE))
+
+    def test_sql(self):
+        sql = str(AccessToken.objects.filter(
+            scope__has_any=constants.WRITE).query)
+        self.assertIn('"oauth2_accesstoken"."scope" & 4) <> 0', sql)
+
+    def test_admin_filter(self):
+        from .admin import AccessTokenAdmin, ScopeListFilter
+        from django.contrib.admin import site
+
+        scope_filter = ScopeListFilter(None, {'scope': str(constants.WRITE)},
+            AccessToken, AccessTokenAdmin(AccessToken, site))
+        self.assertEqual(set([self.write.pk, self.read_write.pk]),
+            set(scope_filter.queryset(None, AccessToken.objects.all())
+                .values_list('pk', flat=True)))
+
+        for value in ('abc', '3'):
+            scope_filter = ScopeListFilter(None, {'scope': value},
+                AccessToken, AccessTokenAdmin(AccessToken, site))
+            self.assertEqual(3, scope_filter.queryset(None,
+                AccessToken.objects.all()).count())
+
+
+class TokenEndpointQueryBudgetTest(TestCase):
+    """
+    Queries each grant type may run on the token endpoint once the client
+    is authenticated. Raise a budget only for a good reason.
+    """
+    def setUp(self):
+        self._tokens = cache.tokens
+        cache.tokens = TokenCache(maxsize=10, ttl=60)
+        self.user, self.oauth_client = create_user_and_client()
+
+    def tearDown(self):
+        cache.tokens = self._tokens
+
+    def post(self, grant_type, **data):
+        data['grant_type'] = grant_type
+        request = RequestFactory().post('/', data)
+        handler = AccessTokenView().get_handler(grant_type)
+        response = handler(request, request.POST, self.oauth_client)
+        self.assertEqual(200, response.status_code, response.content)
+        return json.loads(response.content)
+
+    def test_authorization_code(self):
+        grant = Grant.objects.create(user=self.user, client=self.oauth_client,
+            redirect_uri=self.oauth_client.redirect_uri, scope=constants.READ)
+        # Grant with its user, grant invalidation, access and refresh token
+        # INSERTs
+        with self.assertNumQueries(4):
+            data = self.post('authorization_code', code=grant.code)
+        self.assertEqual(AccessToken.objects.get().refresh_token.token,
+            data['refresh_token'])
+
+    def test_endpoint(self):
+        grant = Grant.objects.create(user=self.user, client=self.oauth_client,
+            redirect_uri=self.oauth_client.redirect_uri, scope=constants.READ)
+        # ClientBackend looks the client up once
+        with self.assertNumQueries(1 + 4):
+            response = self.client.post(reverse('oauth2:access_token'), {
+                'grant_type': 'authorization_code',
+                'client_id': self.oauth_client.client_id,
+                'client_secret': self.oauth_client.client_secret,
+                'code': grant.code})
+        self.assertEqual(200, response.status_code, response.content)
+
+    def test_password(self):
+        # User, access and refresh token INSERTs
+        with self.assertNumQueries(3):
+            data = self.post('password', username='token-user',
+                password='test')
+        self.assertIn('refresh_token', data)
+
+    def test_password_public_client(self):
+        self.oauth_client.client_type = 1
+        self.oauth_client.save()
+        # User, access token INSERT
+        with self.assertNumQueries(2):
+            data = self.post('password', username='token-user',
+                password='test')
+        self.assertNotIn('refresh_token', data)
+
+    def test_refresh_token(self):
+        at = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client, scope=constants.READ)
+        rt = RefreshToken.objects.create(user=self.user, access_token=at,
+            client=self.oauth_client)
+        # Refresh token with its access token and user, four statements
+        # rotating it in a transaction
+        with self.assertNumQueries(7):
+            data = self.post('refresh_token', refresh_token=rt.token)
+        self.assertEqual(AccessToken.objects.get().refresh_token.token,
+            data['refresh_token'])
+
+    def test_response_looks_refresh_token_up(self):
+        at = AccessToken.objects.create(user=self.user,
+            client=self.oauth_client)
+        rt = RefreshToken.objects.create(user=self.user, access_token=at,
+            client=self.oauth_client)
+        view = AccessTokenView()
+
+        at = AccessToken.objects.get(pk=at.pk)
+        with self.assertNumQueries(1):
+            data = json.loads(view.access_token_response(at).content)
+        self.assertEqual(rt.token, data['refresh_token'])
+        with self.assertNumQueries(0):
+            data = json.loads(view.access_token_response(at, None).content)
+        self.assertNotIn('refresh_token', data)
+
+    def test_single_access_token(self):
+        constants.SINGLE_ACCESS_TOKEN = True
+        try:
+            self.post('password', username='token-user',
+                password='test')
+            # User, existing access token with its refresh token
+            with self.assertNumQueries(2):
+                data = self.post('password', username='token-user',
+                    password='test')
+        finally:
+            constants.SINGLE_ACCESS_TOKEN = False
+        self.assertEqual(AccessToken.objects.get().refresh_token.token,
+            data['refresh_token'])
+
+
+class ValidatorsTest(TestCase):
+    def setUp(self):
+        self.user, self.oauth_client = create_user_and_client(
+            scope=constants.READ_WRITE)
+        self.grant = Grant.objects.create(user=self.user,
+            client=self.oauth_client, scope=constants.READ,
+            redirect_uri=self.oauth_client.redirect_uri)
+        self.refresh_token = RefreshToken.objects.create(user=self.user,
+            client=self.oauth_client, access_token=AccessToken.objects.create(
+                user=self.user, client=self.oauth_client, scope=constants.READ))
+
+    def validate(self, validate, form_class, **params):
+        data = QueryDict('', mutable=True)
+        for key, values in params.items():
+            data.setlist(key, values if isinstance(values, list) else [values])
+
+        form = form_class(data, client=self.oauth_client)
+        if form.is_valid():
+            cleaned = validate(data, self.oauth_client)
+            self.assertEqual(form.cleaned_data, cleaned)
+            return cleaned
+        with self.assertRaises(validators.OAuthValidationError) as context:
+            validate(data, self.oauth_client)
+        self.assertEqual(dict(form.errors), context.exception.args[0])
+        return context.exception.args[0]
+
+    def test_authorization_code_grant(self):
+        validate = validators.validate_authorization_code_grant
+        form_class = AuthorizationCodeGrantForm
+        self.assertEqual(self.grant.pk, self.validate(validate, form_class,
+            code=self.grant.code, scope='read')['grant'].pk)
+        self.assertEqual('invalid_request',
+            self.validate(validate, form_class)['error'])
+        self.assertEqual('invalid_grant',
+            self.validate(validate, form_class, code='unknown')['error'])
+        self.assertEqual('invalid_request', self.validate(validate,
+            form_class, code=self.grant.code, scope='unknown')['error'])
+        self.assertEqual('invalid_scope', self.validate(validate,
+            form_class, code=self.grant.code, scope=['read', 'write'])['error'])
+
+    def test_refresh_token_grant(self):
+        validate = validators.validate_refresh_token_grant
+        form_class = RefreshTokenGrantForm
+        self.assertEqual(self.refresh_token.pk, self.validate(validate,
+            form_class, refresh_token=self.refresh_token.token)[
+                'refresh_token'].pk)
+        self.assertEqual('invalid_grant', self.validate(validate,
+            form_class, refresh_token='unknown')['error'])
+        self.assertEqual('invalid_scope', self.validate(validate,
+            form_class, refresh_token=self.refresh_token.token,
+            scope='read write')['error'])
+
+    def test_password_grant(self):
+        validate = validators.validate_password_grant
+        form_class = PasswordGrantForm
+        self.assertEqual(self.user.pk, self.validate(validate, form_class,
+            username='token-user', password='test', scope='read')['user'].pk)
+        self.assertEqual('invalid_credentials', self.validate(validate,
+            form_class, username='token-user', password='wrong')['error'])
+
+    def test_stops_at_first_error(self):
+        # The forms go on to clean() after a field failed
+        self.assertRaisesRegexp(validators.OAuthValidationError,
+            'invalid_request', validators.validate_password_grant,
+            {'username': 'token-user', 'password': ''}, self.oauth_client)
+        self.oauth_client.scope = constants.READ
+        self.assertRaisesRegexp(validators.OAuthValidationError,
+            'invalid_scope', validators.validate_authorization_code_grant,
+            {'code': self.grant.code, 'scope': 'write'}, self.oauth_client)
+
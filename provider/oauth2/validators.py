@@ -0,0 +1,150 @@
+"""
+Plain function counterparts of the token endpoint forms in
+:mod:`provider.oauth2.forms`. They validate the same parameters, in the same
+order, and raise :class:`provider.forms.OAuthValidationError` with the same
+error dicts, without building a form and its fields on every request.
+
+The ``validate_*`` functions take the request data and the authenticated
+client and return what the corresponding form would have as its
+``cleaned_data``. The forms use the ``clean_*`` functions for their fields,
+so custom form subclasses keep working as before.
+"""
+
+from django.contrib.auth import authenticate
+from django.utils.encoding import smart_unicode
+from django.utils.translation import ugettext as _
+from .. import scope
+from ..forms import OAuthValidationError
+from .managers import lookup
+from .models import RefreshToken
+from .stores import get_grant_store
+from . import cache
+
+
+def _get(data, key):
+    # Missing and empty parameters are both cleaned to ''
+    return data.get(key) or ''
+
+
+def clean_scope(data, client=None):
+    """
+    Return the scope requested in ``data`` as an integer, ``0`` if there is
+    no ``scope`` parameter. The scope names may be given in one or more
+    parameters, each a space separated list as defined in :rfc:`3.3`.
+    """
+    if 'scope' not in data:
+        return 0
+
+    values = data.getlist('scope') if hasattr(data, 'getlist') else \
+        [data['scope']]
+    if not values:
+        return 0
+    names = u' '.join(smart_unicode(value) for value in values).split(u' ')
+
+    for name in names:
+        if name not in scope.SCOPE_NAME_DICT:
+            raise OAuthValidationError({
+                'error': 'invalid_request',
+                'error_description': _("'%s' is not a valid scope.") % name})
+
+    cleaned_scope = scope.to_int(default=0, *names)
+
+    # All of the requested scopes must exist in the allowed scopes
+    if client and not scope.check(cleaned_scope, client.scope):
+        raise OAuthValidationError({
+            'error': 'invalid_scope',
+            'error_description': _("The requested scope is not allowed "
+                "for this client")
+        })
+    return cleaned_scope
+
+
+def check_scope(want_scope, has_scope):
+    """
+    Make sure that the scope ``want_scope`` is less or equal to
+    ``has_scope``. A ``want_scope`` of ``0`` asks for no particular scope.
+    """
+    if want_scope and not scope.check(want_scope, has_scope):
+        raise OAuthValidationError({'error': 'invalid_scope'})
+
+
+def clean_code(code, client):
+    """
+    Return the unexpired grant of ``client`` for the authorization ``code``.
+    """
+    if not code:
+        raise OAuthValidationError({'error': 'invalid_request'})
+
+    grant = get_grant_store().get(client, code)
+    if grant is None:
+        raise OAuthValidationError({'error': 'invalid_grant'})
+    return grant
+
+
+def clean_refresh_token(token, client):
+    """
+    Return the unexpired refresh token of ``client`` for ``token`` with its
+    access token and user.
+    """
+    if not token:
+        raise OAuthValidationError({'error': 'invalid_request'})
+
+    rejected_key = ('refresh', getattr(client, 'pk', None), token)
+    if cache.rejected.get(rejected_key):
+        raise OAuthValidationError({'error': 'invalid_grant'})
+
+    try:
+        refresh_token = RefreshToken.objects.select_related('access_token',
+            'user').get(expired=False, client=client, **lookup('token', token))
+    except RefreshToken.DoesNotExist:
+        cache.rejected.set(rejected_key, True)
+        raise OAuthValidationError({'error': 'invalid_grant'})
+    # Rows saved without their plaintext only have the digest
+    refresh_token.token = token
+    return refresh_token
+
+
+def clean_credentials(username, password):
+    """
+    Return the user authenticated by ``username`` and ``password``.
+    """
+    user = authenticate(username=username.lower(), password=password)
+    if user is None:
+        raise OAuthValidationError({'error': 'invalid_credentials'})
+    return user
+
+
+def validate_authorization_code_grant(data, client):
+    """
+    Validate like :class:`provider.oauth2.forms.AuthorizationCodeGrantForm`.
+    """
+    code = _get(data, 'code')
+    grant = clean_code(code, client)
+    want_scope = clean_scope(data, client)
+    check_scope(want_scope, grant.scope)
+    return {'code': code, 'grant': grant, 'scope': want_scope}
+
+
+def validate_refresh_token_grant(data, client):
+    """
+    Validate like :class:`provider.oauth2.forms.RefreshTokenGrantForm`.
+    """
+    refresh_token = clean_refresh_token(_get(data, 'refresh_token'), client)
+    want_scope = clean_scope(data, client)
+    check_scope(want_scope, refresh_token.access_token.scope)
+    return {'refresh_token': refresh_token, 'scope': want_scope}
+
+
+def validate_password_grant(data, client):
+    """
+    Validate like :class:`provider.oauth2.forms.PasswordGrantForm`.
+    """
+    username = _get(data, 'username')
+    if not username:
+        raise OAuthValidationError({'error': 'invalid_request'})
+    password = _get(data, 'password')
+    if not password:
+        raise OAuthValidationError({'error': 'invalid_request'})
+    want_scope = clean_scope(data, client)
+    return {'username': username, 'password': password,
+        'user': clean_credentials(username, password), 'scope': want_scope}
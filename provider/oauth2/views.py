@@ -1,14 +1,18 @@
-from datetime import timedelta
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from .. import constants
 from ..views import Capture, Authorize, Redirect
 from ..views import AccessToken as AccessTokenView, OAuthError
-from ..utils import now
+from ..forms import OAuthValidationError
+from ..utils import now, signed_token
 from .forms import AuthorizationRequestForm, AuthorizationForm
-from .forms import PasswordGrantForm, RefreshTokenGrantForm
-from .forms import AuthorizationCodeGrantForm
 from .models import Client, RefreshToken, AccessToken
-from .backends import BasicClientBackend, RequestParamsClientBackend, PublicClientBackend
+from .backends import ClientBackend
+from .stores import get_grant_store
+from .validators import check_scope, clean_scope
+from .validators import validate_authorization_code_grant
+from .validators import validate_password_grant, validate_refresh_token_grant
+from . import cache
 
 
 class Capture(Capture):
@@ -31,7 +35,7 @@ class Authorize(Authorize):
 
     def get_client(self, client_id):
         try:
-            return Client.objects.get(client_id=client_id)
+            return Client.objects.get_client(client_id)
         except Client.DoesNotExist:
             return None
 
@@ -48,7 +52,7 @@ class Authorize(Authorize):
         grant.user = request.user
         grant.client = client
         grant.redirect_uri = client_data.get('redirect_uri', '')
-        grant.save()
+        get_grant_store().save(grant)
         return grant.code
 
 
@@ -69,34 +73,36 @@ class AccessTokenView(AccessTokenView):
         *or* the :attr:`grant_types` list.
     """
     authentication = (
-        BasicClientBackend,
-        RequestParamsClientBackend,
-        PublicClientBackend,
+        ClientBackend,
     )
 
+    # The grant type parameters are checked with the functions in
+    # provider.oauth2.validators rather than the equivalent forms, which
+    # cost a lot more to build and clean on every request.
+
     def get_authorization_code_grant(self, request, data, client):
-        form = AuthorizationCodeGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data.get('grant')
+        try:
+            return validate_authorization_code_grant(data, client)['grant']
+        except OAuthValidationError, e:
+            raise OAuthError(e.args[0])
 
     def get_refresh_token_grant(self, request, data, client):
-        form = RefreshTokenGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data.get('refresh_token')
+        try:
+            return validate_refresh_token_grant(data, client)['refresh_token']
+        except OAuthValidationError, e:
+            raise OAuthError(e.args[0])
 
     def get_password_grant(self, request, data, client):
-        form = PasswordGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data
+        try:
+            return validate_password_grant(data, client)
+        except OAuthValidationError, e:
+            raise OAuthError(e.args[0])
 
     def get_access_token(self, request, user, scope, client):
         try:
             # Attempt to fetch an existing access token.
-            at = AccessToken.objects.filter(user=user, client=client,
-                                            scope=scope, expires__gt=now())[0]
+            at = AccessToken.objects.select_related('refresh_token').filter(
+                user=user, client=client, scope=scope, expires__gt=now())[0]
         except IndexError:
             # None found... make a new one!
             at = self.create_access_token(request, user, scope, client)
@@ -104,6 +110,15 @@ class AccessTokenView(AccessTokenView):
         return at
 
     def create_access_token(self, request, user, scope, client):
+        if constants.SIGNED_TOKENS:
+            expires = client.get_default_token_expiry().replace(microsecond=0)
+            return AccessToken.objects.create(
+                user=user,
+                client=client,
+                scope=scope,
+                expires=expires,
+                token=signed_token(user.pk, client.pk, scope, expires)
+            )
         return AccessToken.objects.create(
             user=user,
             client=client,
@@ -111,20 +126,79 @@ class AccessTokenView(AccessTokenView):
         )
 
     def create_refresh_token(self, request, user, scope, access_token, client):
-        return RefreshToken.objects.create(
+        rt = RefreshToken.objects.create(
             user=user,
             access_token=access_token,
             client=client
         )
+        # Spare get_refresh_token a query for it
+        access_token.refresh_token = rt
+        return rt
+
+    def refresh_token(self, request, data, client):
+        # Within the grace period the refresh token is expired already
+        token = data.get('refresh_token')
+        at = cache.rotated.get(client.pk, token)
+        if at is None:
+            try:
+                return super(AccessTokenView, self).refresh_token(request,
+                    data, client)
+            except OAuthError, e:
+                # Exchanged by a request that hasn't published its pair yet
+                if not cache.rotated.enabled or \
+                        e.args[0].get('error') != 'invalid_grant':
+                    raise
+                at = cache.rotated.wait(client.pk, token)
+                if at is None:
+                    raise
+        try:
+            check_scope(clean_scope(data, client), at.scope)
+        except OAuthValidationError, e:
+            raise OAuthError(e.args[0])
+        return self.access_token_response(at, self.get_refresh_token(at))
+
+    def rotate_refresh_token(self, request, rt, client):
+        """
+        Rotate ``rt`` in a single transaction. Marking it as expired is
+        conditional and locks its row until the transaction ends, so of
+        concurrent requests presenting the same refresh token only the first
+        gets a new pair. The others get the same pair during the
+        :attr:`provider.constants.REFRESH_GRACE_PERIOD`, once it is published
+        after the transaction commits.
+        """
+        at = rt.access_token
+
+        with transaction.atomic():
+            if not RefreshToken.objects.filter(pk=rt.pk,
+                    expired=False).update(expired=True):
+                rotated = cache.rotated.get(client.pk, rt.token)
+                if rotated is None:
+                    raise OAuthError({'error': 'invalid_grant'})
+                return rotated
+
+            if constants.DELETE_EXPIRED:
+                # Takes the refresh token along
+                at.delete()
+            else:
+                AccessToken.all_objects.filter(pk=at.pk).update(
+                    is_deleted=True)
+
+            new_at = self.create_access_token(request, rt.user, at.scope,
+                client)
+            self.create_refresh_token(request, rt.user, at.scope, new_at,
+                client)
+            # Published only once it is visible to the others
+            transaction.on_commit(
+                lambda: cache.rotated.set(client.pk, rt.token, new_at))
+
+        cache.evict(at)
+        return new_at
 
     def invalidate_grant(self, grant):
-        if constants.DELETE_EXPIRED:
-            grant.delete()
-        else:
-            grant.expires = now() - timedelta(days=1)
-            grant.save()
+        return get_grant_store().consume(grant)
 
     def invalidate_refresh_token(self, rt):
+        cache.tokens.discard(rt.access_token)
         if constants.DELETE_EXPIRED:
             rt.delete()
         else:
@@ -135,5 +209,5 @@ class AccessTokenView(AccessTokenView):
         if constants.DELETE_EXPIRED:
             at.delete()
         else:
-            at.expires = now() - timedelta(days=1)
-            at.save()
+            AccessToken.all_objects.filter(pk=at.pk).revoke()
+            at.is_deleted = True
@@ -1,8 +1,12 @@
+import calendar
 import hashlib
 import shortuuid
 from datetime import datetime, tzinfo
 from django.conf import settings
+from django.core import signing
 from django.utils import dateparse
+from django.utils.crypto import get_random_string
+from django.utils.encoding import force_bytes
 from django.db.models.fields import (DateTimeField, DateField,
                                      EmailField, TimeField,
                                      FieldDoesNotExist)
@@ -45,6 +49,64 @@ def long_token():
     return hash.hexdigest()
 
 
+def token_digest(token):
+    """
+    Return the fixed width binary digest that tokens and codes are indexed
+    and, with :attr:`settings.OAUTH_TOKEN_DIGESTS`, looked up by.
+    """
+    return hashlib.sha256(force_bytes(token)).digest()
+
+
+SIGNED_TOKEN_SALT = 'provider.oauth2.access_token'
+
+
+def signed_token(user_id, client_id, scope, expires):
+    """
+    Generate a self-contained access token carrying the user and client
+    identifiers, the scope and the expiry, signed with
+    :attr:`settings.SECRET_KEY`. Such tokens can be verified with
+    :func:`read_signed_token` without looking them up.
+
+    ``expires`` is stored with a precision of one second.
+    """
+    if timezone.is_naive(expires):
+        expires = timezone.make_aware(expires, timezone.get_default_timezone())
+    return signing.dumps({
+        'u': user_id,
+        'c': client_id,
+        's': scope,
+        'e': calendar.timegm(expires.utctimetuple()),
+        # Tell apart tokens issued for the same grant within one second
+        'n': get_random_string(8),
+    }, salt=SIGNED_TOKEN_SALT, compress=True)
+
+
+def read_signed_token(token):
+    """
+    Return the payload of a token generated by :func:`signed_token` as a
+    ``dict`` with the keys ``user_id``, ``client_id``, ``scope`` and
+    ``expires``, or ``None`` if ``token`` isn't a validly signed token.
+    Expired tokens are returned as well, it's up to the caller to check.
+    """
+    # Opaque tokens are hex digests and never contain the separator
+    if ':' not in token:
+        return None
+    try:
+        payload = signing.loads(token, salt=SIGNED_TOKEN_SALT)
+    except signing.BadSignature:
+        return None
+    expires = datetime.utcfromtimestamp(payload['e']).replace(
+        tzinfo=timezone.utc)
+    if not settings.USE_TZ:
+        expires = timezone.make_naive(expires, timezone.get_default_timezone())
+    return {
+        'user_id': payload['u'],
+        'client_id': payload['c'],
+        'scope': payload['s'],
+        'expires': expires,
+    }
+
+
 def get_token_expiry(public=True):
     """
     Return a datetime object indicating when an access token should expire.
@@ -11,6 +11,10 @@ from . import constants, scope
 from provider.oauth2.models import AccessToken as AccessTokenModel
 
 
+# Default of access_token_response's refresh_token: look it up
+_LOOKUP = object()
+
+
 class OAuthError(Exception):
     """
     Exception to throw inside any views defined in :attr:`provider.views`.
@@ -465,9 +469,11 @@ class AccessToken(OAuthView, Mixin):
     def invalidate_grant(self, grant):
         """
         Override to handle grant invalidation. A grant is invalidated right
-        after creating an access token from it.
+        before creating an access token from it.
 
-        :return None:
+        :return: ``False`` if the grant was invalidated already, by a
+            concurrent request exchanging the same code. No token is issued
+            then.
         """
         raise NotImplementedError
 
@@ -498,11 +504,18 @@ class AccessToken(OAuthView, Mixin):
         return HttpResponse(json.dumps(error), content_type=content_type,
                 status=status, **kwargs)
 
-    def access_token_response(self, access_token):
+    def access_token_response(self, access_token, refresh_token=_LOOKUP):
         """
         Returns a successful response after creating the access token
         as defined in :rfc:`5.1`.
+
+        The handlers pass in the ``refresh_token`` issued along with
+        ``access_token``, or ``None`` if there is none, so building the
+        response doesn't hit the database. Without it the refresh token is
+        looked up with :meth:`get_refresh_token`.
         """
+        if refresh_token is _LOOKUP:
+            refresh_token = self.get_refresh_token(access_token)
 
         response_data = {
             'access_token': access_token.token,
@@ -513,16 +526,26 @@ class AccessToken(OAuthView, Mixin):
 
         # Not all access_tokens are given a refresh_token
         # (for example, public clients doing password auth)
-        try:
-            rt = access_token.refresh_token
-            response_data['refresh_token'] = rt.token
-        except ObjectDoesNotExist:
-            pass
+        if refresh_token is not None:
+            response_data['refresh_token'] = refresh_token.token
 
         return HttpResponse(
             json.dumps(response_data), content_type='application/json'
         )
 
+    def get_refresh_token(self, access_token):
+        """
+        Return the refresh token of an existing ``access_token`` or ``None``,
+        for access tokens the handlers didn't just create. Override to load
+        it along with the access token.
+
+        :return: ``object`` - Refresh token or ``None``
+        """
+        try:
+            return access_token.refresh_token
+        except ObjectDoesNotExist:
+            return None
+
     def authorization_code(self, request, data, client):
         """
         Handle ``grant_type=authorization_code`` requests as defined in
@@ -530,32 +553,45 @@ class AccessToken(OAuthView, Mixin):
         """
         grant = self.get_authorization_code_grant(request, request.POST,
                 client)
+
+        # Only one of concurrent exchanges of the same code may succeed
+        if self.invalidate_grant(grant) is False:
+            return self.error_response({'error': 'invalid_grant'})
+
         if constants.SINGLE_ACCESS_TOKEN:
             at = self.get_access_token(request, grant.user, grant.scope, client)
+            rt = self.get_refresh_token(at)
         else:
             at = self.create_access_token(request, grant.user, grant.scope, client)
             rt = self.create_refresh_token(request, grant.user, grant.scope, at,
                     client)
 
-        self.invalidate_grant(grant)
-
-        return self.access_token_response(at)
+        return self.access_token_response(at, rt)
 
     def refresh_token(self, request, data, client):
         """
         Handle ``grant_type=refresh_token`` requests as defined in :rfc:`6`.
         """
         rt = self.get_refresh_token_grant(request, data, client)
+        at = self.rotate_refresh_token(request, rt, client)
+        return self.access_token_response(at, self.get_refresh_token(at))
 
+    def rotate_refresh_token(self, request, rt, client):
+        """
+        Invalidate the refresh token ``rt`` and its access token and issue a
+        new pair in their place. Override to do so in fewer statements or in
+        a transaction.
+
+        :return: ``object`` - The new access token
+        """
         # this must be called first in case we need to purge expired tokens
         self.invalidate_refresh_token(rt)
         self.invalidate_access_token(rt.access_token)
 
         at = self.create_access_token(request, rt.user, rt.access_token.scope,
                 client)
-        rt = self.create_refresh_token(request, at.user, at.scope, at, client)
-
-        return self.access_token_response(at)
+        self.create_refresh_token(request, at.user, at.scope, at, client)
+        return at
 
     def password(self, request, data, client):
         """
@@ -574,15 +610,17 @@ class AccessToken(OAuthView, Mixin):
         user = data.get('user')
         scope = data.get('scope')
 
+        rt = None
         if constants.SINGLE_ACCESS_TOKEN:
             at = self.get_access_token(request, user, scope, client)
+            rt = self.get_refresh_token(at)
         else:
             at = self.create_access_token(request, user, scope, client)
             # Public clients don't get refresh tokens
             if client.client_type != 1:
                 rt = self.create_refresh_token(request, user, scope, at, client)
 
-        return self.access_token_response(at)
+        return self.access_token_response(at, rt)
 
     def get_handler(self, grant_type):
         """